@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Guard against regressions of the package import time.
+
+Runs `python -X importtime -c "import interactive_plotting"` in a fresh
+interpreter, checks that none of the heavy dependencies are imported
+and that the cumulative import time stays below a threshold.
+
+Usage: python benchmarks/import_time.py [--max-ms MS] [--repeats N]
+'''
+
+from argparse import ArgumentParser
+
+import os
+import re
+import subprocess
+import sys
+
+
+PACKAGE = 'interactive_plotting'
+HEAVY_MODULES = ('scanpy', 'holoviews', 'bokeh', 'networkx', 'datashader', 'panel')
+MAX_MS = 100
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# import time:  self [us] | cumulative | imported package
+LINE_PAT = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def import_time(package=PACKAGE):
+    '''
+    Import a package in a fresh interpreter.
+
+    Params
+    --------
+    package: Str, optional (default: `'interactive_plotting'`)
+        package to import
+
+    Returns
+    --------
+    (cumulative_ms, modules): Tuple[Float, Set[Str]]
+        cumulative import time of the package in milliseconds
+        and names of all the imported modules
+    '''
+
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))}
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {package}'],
+                         capture_output=True, text=True, env=env, cwd=ROOT)
+    assert res.returncode == 0, f'Unable to import `{package}`:\n{res.stderr}'
+
+    cumulative, modules = None, set()
+    for line in res.stderr.splitlines():
+        match = LINE_PAT.match(line)
+        if match is None:
+            continue
+        _, cum, indent, name = match.groups()
+        modules.add(name)
+        if name == package and not indent.strip(' '):
+            cumulative = int(cum) / 1000
+
+    assert cumulative is not None, f'Import time of `{package}` not found.'
+
+    return cumulative, modules
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-ms', type=float, default=MAX_MS, help='maximum cumulative import time in ms')
+    parser.add_argument('--repeats', type=int, default=5, help='number of imports, the fastest one is used')
+    args = parser.parse_args()
+
+    times, modules = zip(*(import_time() for _ in range(args.repeats)))
+    modules = set.union(*modules)
+    best = min(times)
+
+    heavy = sorted(m for m in modules if m.split('.')[0] in HEAVY_MODULES)
+    assert not heavy, f'`import {PACKAGE}` imports heavy dependencies: `{heavy}`.'
+    assert best <= args.max_ms, f'`import {PACKAGE}` took `{best:.1f}` ms, expected at most `{args.max_ms}` ms.'
+
+    print(f'import {PACKAGE}: {best:.1f} ms (max. {args.max_ms} ms), {len(modules)} modules')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,53 @@
-from . import utils
-
-from .bokeh_plots import interactive_hist, \
-                         thresholding_hist, \
-                         highlight_de, \
-                         link_plot, \
-                         gene_trend
-from .holoviews_plots import scatter, scatterc, dpt, graph
-
-from .plots import heatmap
-from .plots import scatter2 as scatter
-from .scatter3d import scatter3d
+from importlib import import_module
+
+import sys
+import types
+
+# submodules are only imported when one of their functions is first accessed,
+# since `scanpy`, `holoviews`, `bokeh`, ... take a long time to import
+_LAZY_ATTRS = {
+    'utils': ('.utils', None),
+    'interactive_hist': ('.bokeh_plots', 'interactive_hist'),
+    'thresholding_hist': ('.bokeh_plots', 'thresholding_hist'),
+    'highlight_de': ('.bokeh_plots', 'highlight_de'),
+    'link_plot': ('.bokeh_plots', 'link_plot'),
+    'gene_trend': ('.bokeh_plots', 'gene_trend'),
+    'scatterc': ('.holoviews_plots', 'scatterc'),
+    'dpt': ('.holoviews_plots', 'dpt'),
+    'graph': ('.holoviews_plots', 'graph'),
+    'heatmap': ('.plots', 'heatmap'),
+    'scatter': ('.plots', 'scatter2'),
+    'scatter3d': ('.scatter3d', 'scatter3d'),
+}
+
+__all__ = list(_LAZY_ATTRS.keys())
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f'module `{__name__}` has no attribute `{name}`')
+
+    module_name, attr = _LAZY_ATTRS[name]
+    module = import_module(module_name, __name__)
+    res = module if attr is None else getattr(module, attr)
+    # importing a submodule sets it as an attribute, e.g. `scatter3d`
+    globals()[name] = res
+
+    return res
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
+
+
+class _Package(types.ModuleType):
+
+    def __setattr__(self, name, value):
+        # `import interactive_plotting.scatter3d` binds the submodule to the package
+        # after it has been imported, keep the function of the same name instead
+        if isinstance(value, types.ModuleType) and _LAZY_ATTRS.get(name, (None, None))[1] == name:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
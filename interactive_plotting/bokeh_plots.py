@@ -14,7 +14,6 @@ import warnings
 
 import numpy as np
 import pandas as pd
-import scanpy as sc
 
 import matplotlib.cm as cm
 import matplotlib.colors as colors
@@ -22,7 +21,8 @@ import matplotlib
 import bokeh
 
 
-from .utils import sample_unif, sample_density, to_hex_palette
+from .utils import sample_unif, sample_density, to_hex_palette, get_column, get_resolver, \
+        color_lut, LUT_SIZE, is_view
 from bokeh.plotting import figure, show, save as bokeh_save
 from bokeh.models import ColumnDataSource, Slider, HoverTool, ColorBar, \
         Patches, Legend, CustomJS, TextInput, LabelSet, Select 
@@ -124,25 +124,20 @@ def _create_mapper(adata, key):
     """
     if not key in adata.obs_keys():
         assert key in adata.var_names,  f'`{key}` not found in `adata.obs_keys()` or `adata.var_names`'
-        ix = np.where(adata.var_names == key)[0][0]
-        vals = list(adata.X[:, ix])
-        palette = cm.get_cmap('viridis', adata.n_obs)
-
-        mapper = dict(zip(vals, range(len(vals))))
-        palette = to_hex_palette(palette([mapper[v] for v in vals]))
+        ix = get_resolver(adata).find('var_names', key)
+        vals = get_column(adata.X, ix, cache=not is_view(adata))
+        palette = list(color_lut(cm.viridis))
 
         return LinearColorMapper(palette=palette, low=np.min(vals), high=np.max(vals))
 
     is_categorical = adata.obs[key].dtype.name == 'category'
-    default_palette = cm.get_cmap('viridis', adata.n_obs if not is_categorical else len(adata.obs[key].unique()))
-    palette = adata.uns.get(f'{key}_colors', default_palette)
+    palette = adata.uns.get(f'{key}_colors', None)
 
-    if palette is default_palette:
-        vals = adata.obs[key].unique() if is_categorical else adata.obs[key]
-        mapper = dict(zip(vals, range(len(vals))))
-        palette = palette([mapper[v] for v in vals])
+    if palette is None:
+        # one color per category or a lookup table for the continuous values
+        palette = color_lut(cm.viridis, len(adata.obs[key].cat.categories) if is_categorical else LUT_SIZE)
 
-    palette = to_hex_palette(palette)
+    palette = list(to_hex_palette(palette))
 
     if is_categorical:
         return CategoricalColorMapper(palette=palette, factors=list(map(str, adata.obs[key].cat.categories)))
@@ -1087,7 +1082,7 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
 
     palette = cm.RdYlBu if palette is None else palette
     if isinstance(palette, matplotlib.colors.Colormap):
-        palette = to_hex_palette(palette(range(palette.N), 1., bytes=True))
+        palette = list(color_lut(palette, palette.N))
 
     if not isinstance(components[0], list):
         components = [components]
@@ -1114,6 +1109,8 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
         if not all(gene_subset):
             warnings.warn('`genes` is not None, are you sure this is what you want when using `dpt` distance?')
 
+        import scanpy as sc
+
         dmat = []
         ad_tmp = adata.copy()
         ad_tmp = ad_tmp[:, gene_subset]
@@ -1229,7 +1226,7 @@ def _get_mappers(adata, df, genes=[], use_raw=True, sort=True):
 
     indices, = np.where(np.in1d(adata.var_names, genes))
     for ix in indices:
-        df[adata.var_names[ix]] = (adata.raw if use_raw else adata).X[:, ix]
+        df[adata.var_names[ix]] = get_column((adata.raw if use_raw else adata).X, ix, cache=not is_view(adata))
 
     return df, mappers
 
@@ -6,30 +6,22 @@ from collections import OrderedDict as odict
 
 from pandas.api.types import is_categorical_dtype, is_string_dtype, infer_dtype
 from scipy.sparse import issparse
-from functools import partial
+from scipy.spatial import cKDTree
+from functools import partial, lru_cache
 from bokeh.palettes import Viridis256
 from datashader.colors import Sets1to3
 from pandas.core.indexes.base import Index
-from holoviews.operation.datashader import datashade, bundle_graph, shade, dynspread, rasterize, spread
+from holoviews.operation.datashader import datashade, shade, dynspread, rasterize, spread
 from holoviews.operation import decimate
 from bokeh.transform import linear_cmap
 from bokeh.models import HoverTool
 
-import scanpy as sc
 import numpy as np
 import pandas as pd
-import networkx as nx
 import holoviews as hv
 import datashader as ds
 import warnings
 
-
-try:
-    assert callable(sc.tl.dpt)
-    dpt_fn = sc.tl.dpt
-except AssertionError:
-    from scanpy.api.tl import dpt as dpt_fn
-
 #TODO: DRY
 
 @wrap_as_panel
@@ -130,8 +122,7 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         else:
             perc = None
 
-        ad, _ = alazy[bs, tuple(comp)]
-        ad_mraw = ad.raw if use_raw else ad
+        ad, ixs = alazy[bs, tuple(comp)]
 
         # because diffmap has small range, it iterferes with
         # the legend created
@@ -147,8 +138,8 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
             data = ad.obsm[gene][:, 0]
         elif gene in ad.obs.keys():
             data = ad.obs[gene].values
-        elif gene in ad_mraw.var_names:
-            data = ad_mraw.obs_vector(gene)
+        elif gene in adata_mraw.var_names:
+            data = get_expression(adata_mraw, gene)[ixs]
         else:
             gene, ix = gene.split(ignore_after)
             ix = int(ix)
@@ -635,7 +626,7 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
 @wrap_as_col
 def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         subsample='datashade', steps=40, use_raw=False, keep_frac=None,
-        sort=True, skip=True, seed=None, show_legend=True, root_cell_all=False,
+        sort=True, skip=True, seed=None, show_legend=True, root_cell_all=False, root_cell_select='widget',
         root_cell_hl=True, root_cell_bbox=True, root_cell_size=None, root_cell_color='orange',
         legend_loc='top_right', size=4, perc=None, show_perc=True, cat_cmap=None, cont_cmap=None,
         plot_height=400, plot_width=400, *args, **kwargs):
@@ -704,6 +695,10 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         show all root cells, even though they might not be in the embedding
         (e.g. when subsample='uniform' or 'density')
         otherwise only show in the embedding (based on the data of the 1st `basis`)
+    root_cell_select: Str, optional (default: `'widget'`)
+        how to select the root cell, possible values are `'widget'` and `'tap'`
+        `'widget'` creates a widget containing all the root cells
+        `'tap'` selects the cell closest to the tapped location in the pseudotime embedding
     root_cell_hl: Bool, optional (default: `True`)
         highlight the root cell
     root_cell_bbox: Bool, optional (default: `True`)
@@ -717,7 +712,7 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
     plot_width: Int, optional (default: `400`)
         width of the plot in pixels
     *args, **kwargs:
-        additional arguments for `sc.tl.dpt`
+        additional arguments for `sc.tl.dpt`, only `n_dcs` is supported
 
     Returns
     --------
@@ -725,6 +720,47 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         holoviews plot wrapped in `panel.Column`
     '''
 
+    @lru_cache(maxsize=None)
+    def get_root_tree(bs, comp):
+        ixs = np.arange(adata.n_obs) if root_cell_all else alazy.get_indices((bs, comp))
+        return cKDTree(adata.obsm[f'X_{bs}'][:, comp][ixs]), ixs
+
+    def find_root(root_cell, bs, comp):
+        if root_cell_select == 'widget':
+            return root_ixs[root_cell]
+
+        # `root_cell` is the tapped location
+        tree, ixs = get_root_tree(bs, comp)
+        x, y = root_cell
+        if x is None or y is None:
+            return ixs[0]
+
+        scale = 1000 if bs == 'diffmap' else 1
+        _, ix = tree.query([x / scale, y / scale])
+
+        return ixs[ix]
+
+    @lru_cache(maxsize=16)
+    def compute_state(root, bs, comp):
+        # shared by all the panels, so that the pseudotime is computed only once per interaction
+        is_diffmap = bs == 'diffmap'
+        ixs = alazy.get_indices((bs, comp))
+
+        # because diffmap has small range, it iterferes with
+        # the legend created
+        emb = adata.obsm[f'X_{bs}'][:, comp][ixs] * (1000 if is_diffmap else 1)
+
+        pseudotime = pt_engine(root)[ixs]  # creates a copy
+        pseudotime[pseudotime == np.inf] = 1
+        pseudotime[pseudotime == -np.inf] = 0
+
+        # find the index of the root cell in maybe subsampled data, `ixs` are sorted
+        rid = np.searchsorted(ixs, root)
+        rid = rid if rid < len(ixs) and ixs[rid] == root else None
+
+        return dict(ixs=ixs, emb=emb, xlim=minmax(emb[:, 0]), ylim=minmax(emb[:, 1]),
+                    data=data[ixs], pseudotime=pseudotime, root=rid)
+
     def create_scatterplot(root_cell, gene, bs, perc_low, perc_high, *args, typp='expr', ret_hl=False):
         ixs = np.where(basis == bs)[0][0]
         is_diffmap = bs == 'diffmap'
@@ -735,8 +771,9 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         else:
             comp = np.array(components[ixs])  # need to make a copy
 
-        ad, _ = alazy[bs, tuple(comp)]
-        ad_mraw = ad.raw if use_raw else ad
+        comp_key = tuple(map(int, comp))
+        state = compute_state(find_root(root_cell, bs, comp_key), bs, comp_key)
+        ixs, emb, pseudotime = state['ixs'], state['emb'], state['pseudotime']
 
         if perc_low is not None and perc_high is not None:
             if perc_low > perc_high:
@@ -745,22 +782,16 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         else:
             perc = None
 
-        # because diffmap has small range, it iterferes with
-        # the legend created
-        emb = ad.obsm[f'X_{bs}'][:, comp] * (1000 if is_diffmap else 1)
         comp += not is_diffmap  # naming consistence
 
         bsu = bs.upper()
         x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
         y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
-        xmin, xmax = minmax(emb[:, 0])
-        ymin, ymax = minmax(emb[:, 1])
-
-        # adata is the original, ad may be subsampled
-        mask = np.in1d(adata.obs_names, ad.obs_names)
+        xmin, xmax = state['xlim']
+        ymin, ymax = state['ylim']
 
         if typp == 'emb_discrete':
-            scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'condition': data[mask]},
+            scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'condition': state['data']},
                                  kdims=[x, y], vdims='condition').sort('condition')
 
             scatter = scatter.opts(title=key,
@@ -780,12 +811,10 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
 
 
         if typp == 'root_cell_hl':
-            # find the index of the root cell in maybe subsampled data
-            rid = np.where(ad.obs_names == root_cell)[0]
-            if not len(rid):
+            rid = state['root']
+            if rid is None:
                 return hv.Scatter([]).opts(axiswise=True, framewise=True)
 
-            rid = rid[0]
             dx, dy = (xmax - xmin) / 25, (ymax - ymin) / 25
             rx, ry = emb[rid, 0], emb[rid, 1]
 
@@ -796,14 +825,6 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
             return root_cell_scatter
 
 
-        adata.uns['iroot'] = np.where(adata.obs_names == root_cell)[0][0]
-        dpt_fn(adata, *args, **kwargs)
-
-        pseudotime = adata.obs['dpt_pseudotime'].values
-        pseudotime = pseudotime[mask]
-        pseudotime[pseudotime == np.inf] = 1
-        pseudotime[pseudotime == -np.inf] = 0
-
         if typp == 'emb':
 
             scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'pseudotime': pseudotime},
@@ -821,12 +842,12 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
                                 ylabel=f'{bsu}{comp[1]}')# if not ret_hl else root_cell_scatter
 
         if typp == 'expr':
-            expr = ad_mraw.obs_vector(gene)
+            expr = get_expression(adata_mraw, gene)[ixs]
 
             x = hv.Dimension('x', label='pseudotime')
             y = hv.Dimension('y', label='expression')
             # data is in outer scope
-            scatter_expr = hv.Scatter({'x': pseudotime, 'y': expr, 'condition': data[mask]},
+            scatter_expr = hv.Scatter({'x': pseudotime, 'y': expr, 'condition': state['data']},
                                       kdims=[x, y], vdims='condition')
 
             scatter_expr = scatter_expr.opts(title=key,
@@ -852,12 +873,19 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
     if kwargs.pop('copy', False):
         adata = adata.copy()
 
+    n_dcs = kwargs.pop('n_dcs', args[0] if len(args) else 10)
+    if len(args) > 1 or len(kwargs):
+        warnings.warn('Only `n_dcs` is used for computing the pseudotime, ignoring the other arguments.')
+    pt_engine = PseudotimeEngine(adata, n_dcs=n_dcs)
+
     if keep_frac is None:
         keep_frac = 0.2
 
     if root_cell_size is None:
         root_cell_size = size * 2
 
+    assert root_cell_select in ('widget', 'tap'), f'Invalid root cell selection `{root_cell_select}`. Possible values are `[\'widget\', \'tap\']`.'
+
     if basis is None:
         basis = np.ravel(sorted(filter(len, map(BS_PAT.findall, adata.obsm.keys()))))
     elif isinstance(basis, str):
@@ -928,9 +956,12 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
     if cont_cmap is None:
         cont_cmap = Viridis256
 
-    kdims = [hv.Dimension('Root cell', values=(adata if root_cell_all else alazy[basis[0], tuple(components[0])][0]).obs_names),
-             hv.Dimension('Gene', values=genes),
+    kdims = [hv.Dimension('Gene', values=genes),
              hv.Dimension('Basis', values=basis)]
+    if root_cell_select == 'widget':
+        kdims.insert(0, hv.Dimension('Root cell', values=(adata if root_cell_all else alazy[basis[0], tuple(components[0])][0]).obs_names))
+        # reversed, so that the first occurrence is kept for duplicated names
+        root_ixs = dict(zip(adata.obs_names[::-1], range(adata.n_obs - 1, -1, -1)))
     cs = lambda cell, gene, bs, *args, **kwargs: create_scatterplot(cell, gene, bs, perc[0], perc[1], *args, **kwargs)
 
     data, is_cat = get_data(adata, key)
@@ -952,12 +983,20 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
             ]
             cs = create_scatterplot
 
-    emb = hv.DynamicMap(partial(cs, typp='emb'), kdims=kdims)
+    streams = []
+    if root_cell_select == 'tap':
+        # the source is set once the embedding is created
+        tap = hv.streams.Tap(x=None, y=None)
+        streams.append(tap)
+        cs_widget = cs
+        cs = lambda *args, x=None, y=None, **kwargs: cs_widget((x, y), *args, **kwargs)
+
+    emb = hv.DynamicMap(partial(cs, typp='emb'), kdims=kdims, streams=streams)
     if root_cell_hl:
-        root_cell = hv.DynamicMap(partial(cs, typp='root_cell_hl'), kdims=kdims)
-    emb_d = hv.DynamicMap(partial(cs, typp='emb_discrete'), kdims=kdims)
-    expr = hv.DynamicMap(partial(cs, typp='expr'), kdims=kdims)
-    hist = hv.DynamicMap(partial(cs, typp='hist'), kdims=kdims)
+        root_cell = hv.DynamicMap(partial(cs, typp='root_cell_hl'), kdims=kdims, streams=streams)
+    emb_d = hv.DynamicMap(partial(cs, typp='emb_discrete'), kdims=kdims, streams=streams)
+    expr = hv.DynamicMap(partial(cs, typp='expr'), kdims=kdims, streams=streams)
+    hist = hv.DynamicMap(partial(cs, typp='hist'), kdims=kdims, streams=streams)
 
     if subsample == 'datashade':
         emb = dynspread(datashade(emb, aggregator=ds.mean('pseudotime'), cmap=cont_cmap,
@@ -979,6 +1018,8 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         emb *= root_cell  # emb * root_cell.opts(axiswise=True, framewise=True)
 
     emb = emb.opts(axiswise=False, framewise=True, frame_height=plot_height, frame_width=plot_width)
+    if root_cell_select == 'tap':
+        tap.source = emb
     expr = expr.opts(axiswise=True, framewise=True, frame_height=plot_height, frame_width=plot_width)
     emb_d = emb_d.opts(axiswise=True, framewise=True, frame_height=plot_height, frame_width=plot_width)
     hist = hist.opts(axiswise=True, framewise=True, frame_height=plot_height, frame_width=plot_width)
@@ -991,10 +1032,10 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
 
 @wrap_as_col
 def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None, color_key_reduction=np.sum,
-          ixs=None, top_n_edges=None, filter_edges=None, directed=True, bundle=False, bundle_kwargs={},
+          ixs=None, top_n_edges=None, filter_edges=None, directed=True, bundle=False, bundle_kwargs={}, bundle_n_jobs=None,
           subsample=None, layouts=None, layout_kwargs={}, force_paga_indices=False,
-          degree_by=None, legend_loc='top_right', node_size=12, edge_width=2, arrowhead_length=None,
-          perc=None, color_edges_by='weight', hover_selection='nodes',
+          degree_by=None, pagerank=False, legend_loc='top_right', node_size=12, edge_width=2, arrowhead_length=None,
+          perc=None, color_edges_by='weight', hover_selection='nodes', coarse_by=None,
           node_cmap=None, edge_cmap=None, plot_height=600, plot_width=600):
     '''
     Params
@@ -1043,18 +1084,27 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
     bundle_kwargs: Dict, optional (defaul: `{}`)
         kwargs for bundler, e.g. `iterations=1` (default `4`)
         for more options, see `hv.operation.datashader.bundle_graph`
+        the bundled edges are cached for each graph, layout and `bundle_kwargs`
+    bundle_n_jobs: Int, optional (default: `None`)
+        if not `None`, bundle the edges of all `layouts` beforehand using this many processes
+        otherwise, the edges are bundled when the layout is first shown
     layouts: List[Str], optional (default: `None`)
-        layout names to use when drawing graph, e.g. `'umap'` in `adata.obsm`
-        or `'kamada_kawai'` from `nx.layouts`
+        layout names to use when drawing graph, e.g. `'umap'` in `adata.obsm`,
+        `'kamada_kawai'` from `nx.layouts` or `'multilevel'` for large graphs
         if `None`, use all available layouts
     layout_kwargs: Dict[Str, Dict], optional (default: `{}`)
-        kwargs for a given layout
+        kwargs for a given layout, e.g. `{'multilevel': {'init': 'umap', 'n_iter': 10, 'max_time': 30}}`
+        to warm start the `'multilevel'` layout from `adata.obsm['X_umap']`
+        the layouts are cached, see `utils.use_layout_cache` for storing them on the disk
     force_paga_indices: Bool, optional (default: `False`)
         by default, when `key='paga'`, all indices are used
         regardless of what was specified
     degree_by: Str, optional (default: `None`)
         if `'weights'`, use edge weights when calculating the degree
         only visible when `hover_selection='nodes'`
+    pagerank: Bool, optional (default: `False`)
+        whether to compute the PageRank of the nodes
+        only visible when `hover_selection='nodes'`
     legend_loc: Str, optional (default: `'top_right'`)
         locations of the legend, if `None`, do not show legend
     node_size: Float, optional (default: `12`)
@@ -1071,6 +1121,13 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
     hover_selection: Str, optional (default: `'nodes'`)
         whether to define hover over `'nodes'` or `'edges'`
         if `subsample == 'datashade'`, it is always `'nodes'`
+    coarse_by: Str, optional (default: `None`)
+        categorical key in `adata.obs`, if not `None`, first show the graph of the clusters
+        where the edge weights are the sum of the weights between the clusters,
+        the weights within the clusters are shown as the node attribute `'internal_weight'`
+        and missing values form the cluster `'nan'`
+        selecting the clusters shows their induced subgraph in a separate plot
+        edge filtering, bundling and subsampling are not applied to the graph of the clusters
     node_cmap: List[Str], optional (default: `datashader.colors.Sets1to3`)
         colormap in hex format for `color_key`
     edge_cmap: List[Str], optional (default: `bokeh.palettes.Viridis256`)
@@ -1095,96 +1152,107 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
         emb[:, 1] = (emb[:, 1] - y_min) / (np.max(emb[:, 1]) - y_min)
         return emb
 
-    def create_graph(adata, data):
+    def create_graph(obs, data, ixs=None):
         if perc is not None:
             data = percentile(data, perc)
-        create_using = nx.DiGraph if directed else nx.Graph
-        g = (nx.from_scipy_sparse_matrix if issparse(data)  else nx.from_numpy_array)(data, create_using=create_using)
-
-        if  filter_edges is not None:
-            minn, maxx = filter_edges
-            minn = minn if minn is not None else -np.inf
-            maxx = maxx if maxx is not None else np.inf
-            for e, attr in list(g.edges.items()):
-                if attr['weight'] < minn or attr['weight'] > maxx:
-                    g.remove_edge(*e)
-
-        to_keep = None
-        if top_n_edges is not None:
-            if isinstance(top_n_edges, (tuple, list)):
-                to_keep, ascending, group_by = top_n_edges
-            else:
-                to_keep, ascending, group_by = top_n_edges, False, 'out'
-
-            source, target = zip(*g.edges)
-            weights = [v['weight'] for v in g.edges.values()]
-            tmp = pd.DataFrame({'out': source, 'in': target, 'w': weights})
-
-            to_keep = set(map(tuple, tmp.groupby(group_by).apply(lambda g: g.sort_values('w', ascending=ascending).take(range(min(to_keep, len(g)))))[['out', 'in']].values))
 
-            for e in list(g.edges):
-                if e not in to_keep:
-                    g.remove_edge(*e)
+        source, target, weight = get_edges(data, directed=directed, filter_edges=filter_edges,
+                                           top_n_edges=top_n_edges)
+        n_nodes = data.shape[0]
 
-        if not len(g.nodes):
+        if not n_nodes:
             raise RuntimeError('Empty graph.')
 
-        if not len(g.edges):
+        if not len(weight):
             msg = 'No edges to visualize.'
             if filter_edges is not None:
                 msg += f' Consider altering the edge filtering thresholds `{filter_edges}`.'
             if top_n_edges is not None:
+                to_keep = top_n_edges[0] if isinstance(top_n_edges, (tuple, list)) else top_n_edges
                 msg += f' Perhaps use more top edges than `{to_keep}`.'
             raise RuntimeError(msg)
 
+        edges = pd.DataFrame({'start': source, 'end': target, 'weight': weight})
+        # columnar node table, shared by all the layouts
+        nodes = odict([('index', np.arange(n_nodes))])
+
         if hover_selection == 'nodes':
-            if directed:
-                nx.set_node_attributes(g, values=dict(g.in_degree(weight=degree_by)),
-                                       name='indegree')
-                nx.set_node_attributes(g, values=dict(g.out_degree(weight=degree_by)),
-                                       name='outdegree')
-                nx.set_node_attributes(g, values=nx.in_degree_centrality(g),
-                                       name='indegree centrality')
-                nx.set_node_attributes(g, values=nx.out_degree_centrality(g),
-                                       name='outdegree centrality')
-            else:
-                nx.set_node_attributes(g, values=dict(g.degree(weight=degree_by)),
-                                       name='degree')
-                nx.set_node_attributes(g, values=nx.degree_centrality(g),
-                                       name='centrality')
+            nodes.update(get_node_metrics(source, target, weight, n_nodes, directed=directed,
+                                          weighted=degree_by is not None, pagerank=pagerank))
 
         if not is_paga:
-            nx.set_node_attributes(g, values=dict(zip(g.nodes.keys(), adata.obs.index)),
-                                   name='name')
-            for key in list(obs_keys):
-                nx.set_node_attributes(g, values=dict(zip(g.nodes.keys(), adata.obs[key])),
-                                       name=key)
-            if color_key is not None:
+            nodes['name'] = np.asarray(obs.index)
+            keys = list(obs_keys)
+            if color_key is not None and color_key in obs.keys() and color_key not in keys:
+                keys.append(color_key)
+            nodes.update(obs_columns(obs, keys))
+            if color_key is not None and color_key not in obs.keys():
                 # color_vals has been set beforehand
-                nx.set_node_attributes(g, values=dict(zip(g.nodes.keys(), adata.obs[color_key] if color_key in adata.obs.keys() else color_vals)),
-                                       name=color_key)
-
+                nodes[color_key] = color_vals if ixs is None else color_vals[ixs]
         else:
-            nx.set_node_attributes(g, values=dict(zip(g.nodes.keys(), adata.obs[color_key].cat.categories)),
-                                   name=color_key)
+            nodes[color_key] = np.array(obs[color_key].cat.categories)
 
-        return g
+        return edges, nodes
 
-    def embed_graph(layout_key, graph):
+    def get_positions(layout_key, graph, ixs=None, fingerprint=None):
+        # `ixs` are the indices of the graph's nodes in `obs`, if it's an induced subgraph
+        edges, nodes = graph
         bs_key = f'X_{layout_key}'
         if bs_key in adata.obsm.keys():
-            emb = adata_ss.obsm[bs_key][:, get_component[layout_key]]
+            emb = get_obsm(bs_key)[:, get_component[layout_key]]
             emb = normalize(emb)
-            layout = dict(zip(graph.nodes.keys(), emb))
-            l_kwargs = {}
+            if ixs is not None:
+                emb = emb[ixs]
         elif layout_key == 'paga':
-            layout = dict(zip(graph.nodes.keys(), paga_pos))
-            l_kwargs = {}
-        elif layout_key in DEFAULT_LAYOUTS:
-            layout = DEFAULT_LAYOUTS[layout_key]
+            emb = paga_pos
+        elif layout_key in default_layouts:
             l_kwargs = layout_kwargs.get(layout_key, {})
+            if isinstance(l_kwargs.get('init', None), str):
+                # warm start from an embedding
+                bs = l_kwargs['init']
+                init = get_obsm(f'X_{bs}')[:, get_component.get(bs, [0, 1])]
+                l_kwargs = {**l_kwargs, 'init': init if ixs is None else init[ixs]}
+            # `networkx` is only used for its layouts, the positions are cached
+            emb = get_layout(layout_key, edges['start'].values, edges['end'].values, edges['weight'].values,
+                             len(nodes['index']), directed=directed, layout_kwargs=l_kwargs, fingerprint=fingerprint)
+
+        return emb
+
+    def embed_nodes(layout_key, graph, ixs=None, fingerprint=None):
+        emb = get_positions(layout_key, graph, ixs=ixs, fingerprint=fingerprint)
+        columns = graph[1]
+        # the columns are not copied
+        nodes = pd.DataFrame(odict([('x', emb[:, 0]), ('y', emb[:, 1]), *columns.items()]), copy=False)
+
+        return hv.Nodes(nodes, kdims=['x', 'y', 'index'], vdims=[c for c in columns.keys() if c != 'index'])
+
+    def embed_edges(layout_key, graph, fingerprint=None):
+        # fast path for datashade, no `hv.Graph` is created
+        if bundle:
+            return hv.Curve(bundle_paths(layout_key), 'x', 'y')
 
-        g = hv.Graph.from_networkx(graph, positions=layout, **l_kwargs)
+        edges, _ = graph
+        emb = get_positions(layout_key, graph, fingerprint=fingerprint)
+
+        return hv.Curve(edge_segments(edges['start'].values, edges['end'].values, emb), 'x', 'y')
+
+    def bundle_paths(layout_key):
+        edges, _ = graph
+        emb = get_positions(layout_key, graph, fingerprint=fingerprint)
+
+        return bundle_edges(edges['start'].values, edges['end'].values, emb,
+                            fingerprint=fingerprint, **bundle_kwargs)
+
+    def embed_bundled(layout_key):
+        g_layout = g[layout_key]  # keep the options
+
+        return g_layout.clone((g_layout.data, g_layout.nodes, split_paths(bundle_paths(layout_key))))
+
+    def embed_graph(layout_key, graph, ixs=None, fingerprint=None):
+        edges, _ = graph
+        nodes = embed_nodes(layout_key, graph, ixs=ixs, fingerprint=fingerprint)
+
+        g = hv.Graph((edges, nodes), vdims='weight')
         g = g.opts(inspection_policy='nodes' if subsample == 'datashade' else hover_selection,
                       tools=['hover', 'box_select'],
                       edge_color=hv.dim(color_edges_by) if color_edges_by is not None else None,
@@ -1199,12 +1267,84 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
 
         return g if arrowhead_length is None else g.opts(arrowhead_length=arrowhead_length)
 
+    def coarse_graph():
+        labels = obs[coarse_by].astype('category')
+        if labels.isna().any():
+            # the missing values form their own cluster
+            if 'nan' not in labels.cat.categories:
+                labels = labels.cat.add_categories('nan')
+            labels = labels.fillna('nan')
+        categories, codes = labels.cat.categories, labels.cat.codes.values
+        assert np.all(codes >= 0), f'Unable to assign all nodes to a cluster of `{coarse_by}`.'
+        adj, sizes, internal = aggregate_graph(data, codes, len(categories))
+        c_source, c_target, c_weight = get_edges(adj, directed=directed)
+        c_fingerprint = graph_fingerprint(c_source, c_target, c_weight, len(categories), directed=directed)
+
+        c_edges = pd.DataFrame({'start': c_source, 'end': c_target, 'weight': c_weight})
+        c_nodes = pd.DataFrame({'index': np.arange(len(categories)), coarse_by: np.array(categories),
+                                'size': sizes, 'internal_weight': internal})
+        if coarse_by == color_key and is_categorical:
+            c_cmap = odict([*node_cmap.items(), ('nan', NA_COLOR)]) if 'nan' not in node_cmap else node_cmap
+        else:
+            # cycle the palette if there are more clusters than colors
+            c_cmap = odict(zip(categories, np.resize(color_lut(Sets1to3), len(categories))))
+
+        def embed_coarse(layout_key):
+            bs_key = f'X_{layout_key}'
+            if bs_key in adata.obsm.keys():
+                # centroids of the clusters
+                emb = normalize(get_obsm(bs_key)[:, get_component[layout_key]])
+                emb = np.stack([np.bincount(codes, weights=emb[:, d], minlength=len(categories))
+                                for d in range(2)], axis=1) / np.maximum(sizes, 1)[:, None]
+            else:
+                emb = get_layout(layout_key, c_source, c_target, c_weight, len(categories), directed=directed,
+                                 layout_kwargs={k: v for k, v in layout_kwargs.get(layout_key, {}).items() if k != 'init'},
+                                 fingerprint=c_fingerprint)
+
+            nodes = hv.Nodes(c_nodes.assign(x=emb[:, 0], y=emb[:, 1]), kdims=['x', 'y', 'index'], vdims=[coarse_by, 'size', 'internal_weight'])
+
+            return hv.Graph((c_edges, nodes), vdims='weight').opts(
+                tools=['hover', 'tap'],
+                node_size=node_size * (0.5 + 2 * hv.dim('size').norm()),
+                node_color=coarse_by,
+                node_cmap=c_cmap,
+                edge_color=hv.dim('weight'),
+                edge_line_width=edge_width * (0.5 + 2 * hv.dim('weight').norm()),
+                edge_cmap=edge_cmap,
+                directed=directed,
+                title=f'{coarse_by} (select to expand)'
+            )
+
+        def embed_detail(layout_key, index):
+            if not len(index):
+                return hv.Graph(([], [])).opts(title='')
+
+            ixs = np.flatnonzero(np.isin(codes, index))
+            try:
+                sub = create_graph(obs.iloc[ixs], induced_subgraph(data, ixs), ixs=ixs)
+            except RuntimeError:  # no edges
+                return hv.Graph(([], [])).opts(title='')
+
+            title = ', '.join(map(str, categories[index]))
+            return embed_graph(layout_key, sub, ixs=ixs).opts(title=title)
+
+        kdims = [hv.Dimension('Layout', values=layouts)]
+        overview = hv.DynamicMap(embed_coarse, kdims=kdims)
+        selection = hv.streams.Selection1D(source=overview)
+        detail = hv.DynamicMap(embed_detail, kdims=kdims, streams=[selection])
+
+        opts = dict(height=plot_height, width=plot_width, xaxis=None, yaxis=None, axiswise=True, framewise=True)
+        return (overview.opts(**opts) + detail.opts(**opts).opts(
+            hv.opts.Graph(node_size=node_size, node_fill_color='orange' if color_key is None else color_key,
+                          node_cmap=node_cmap, edge_cmap=edge_cmap)
+        )).cols(2)
+
     def get_nodes(layout_key):  # DRY DRY DRY
-        nodes = bundled[layout_key].nodes
+        nodes = embed_nodes(layout_key, graph, fingerprint=fingerprint)
         bs_key = f'X_{layout_key}'
 
         if bs_key in adata.obsm.keys():
-            emb = adata_ss.obsm[bs_key][:, get_component[layout_key]]
+            emb = get_obsm(bs_key)[:, get_component[layout_key]]
             emb = normalize(emb)
             xlim = minmax(emb[:, 0])
             ylim = minmax(emb[:, 1])
@@ -1212,7 +1352,7 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
             xlim = minmax(paga_pos[:, 0])
             ylim = minmax(paga_pos[:, 1])
         else:
-            xlim, ylim = bundled[layout_key].range('x'), bundled[layout_key].range('y')
+            xlim, ylim = nodes.range('x'), nodes.range('y')
 
         xlim, ylim = pad(*xlim), pad(*ylim)  # for datashade
 
@@ -1240,6 +1380,10 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
     if color_key is not None:
         assert color_key in adata.obs or color_key in ('incoming', 'outgoing'), f'Color key `{color_key}` not found in `adata.obs` and is not \'incoming\' or \'outgoing\'.'
 
+    if coarse_by is not None:
+        assert coarse_by in adata.obs.keys(), f'Key `{coarse_by}` not found in `adata.obs`.'
+        assert not key.startswith('p:') and key != 'paga', 'PAGA graph is already a graph of the clusters.'
+
     if obs_keys is None:
         obs_keys = adata.obs.keys()
     else:
@@ -1279,15 +1423,22 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
         assert np.min(ixs) >= 0
         assert np.max(ixs) < adata.shape[0]
 
-    data = data[ixs, :][:, ixs]
-    adata_ss = adata[ixs, :] if not is_paga or (len(ixs) != data.shape[0] and force_paga_indices) else adata
+    data = induced_subgraph(data, ixs)
+    # the observations are subsetted only once, then reused for the positions, colors and tooltips
+    is_subset = not is_paga or (len(ixs) != data.shape[0] and force_paga_indices)
+    obs = adata.obs.iloc[ixs] if is_subset else adata.obs
+
+    @lru_cache(maxsize=None)
+    def get_obsm(bs_key):
+        return np.asarray(adata.obsm[bs_key])[ixs] if is_subset else np.asarray(adata.obsm[bs_key])
 
+    default_layouts = get_default_layouts()
     if layouts is None:
-        layouts = list(DEFAULT_LAYOUTS.keys())
+        layouts = list(default_layouts.keys())
     if isinstance(layouts, str):
         layouts = [layouts]
     for l in layouts:
-        assert l in DEFAULT_LAYOUTS.keys(), f'Unknown layout `{l}`. Available layouts are `{list(DEFAULT_LAYOUTS.keys())}`.'
+        assert l in default_layouts.keys(), f'Unknown layout `{l}`. Available layouts are `{list(default_layouts.keys())}`.'
 
     if np.min(data) < 0 and 'kamada_kawai' in layouts:
         warnings.warn('`kamada_kawai` layout required non-negative edges, removing it from the list of possible layouts.')
@@ -1328,15 +1479,15 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
 
     is_categorical = False
     if color_key is not None:
-        node_cmap = adata_ss.uns[f'{color_key}_colors'] if f'{color_key}_colors' in adata_ss.uns else node_cmap
+        node_cmap = adata.uns[f'{color_key}_colors'] if f'{color_key}_colors' in adata.uns else node_cmap
         if color_key in adata.obs:
-            color_vals = adata_ss.obs[color_key]
+            color_vals = obs[color_key]
             if is_categorical_dtype(color_vals) or is_string_dtype(adata.obs[color_key]):
                 color_vals = color_vals.astype('category').cat.categories
                 is_categorical = True
                 node_cmap = odict(zip(color_vals, to_hex_palette(node_cmap)))
             else:
-                color_vals = adata_ss.obs[color_key].values
+                color_vals = obs[color_key].values
         else:
             print(data.shape)
             color_vals = np.array(color_key_reduction(data, axis=int(color_key == 'outgoing'))).flatten()
@@ -1353,17 +1504,23 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
         warnings.warn('Nothing to plot, no layouts found.')
         return
 
+    if coarse_by is not None:
+        return coarse_graph()
+
     # because of the categories
-    graph = create_graph(adata_ss, data=data)
+    graph = create_graph(obs, data=data)
+    edges, _ = graph
+    fingerprint = graph_fingerprint(edges['start'].values, edges['end'].values, edges['weight'].values,
+                                    data.shape[0], directed=directed)
 
     kdims = [hv.Dimension('Layout', values=layouts)]
-    g = hv.DynamicMap(partial(embed_graph, graph=graph), kdims=kdims).opts(axiswise=True, framewise=True)  # necessary as well
+    g = hv.DynamicMap(partial(embed_graph, graph=graph, fingerprint=fingerprint), kdims=kdims).opts(axiswise=True, framewise=True)  # necessary as well
 
     if subsample != 'datashade':
         for layout_key in layouts:
             bs_key = f'X_{layout_key}'
             if bs_key in adata.obsm.keys():
-                emb = adata_ss.obsm[bs_key][:, get_component[layout_key]]
+                emb = get_obsm(bs_key)[:, get_component[layout_key]]
                 emb = normalize(emb)
                 xlim = minmax(emb[:, 0])
                 ylim = minmax(emb[:, 1])
@@ -1375,11 +1532,21 @@ def graph(adata, key, basis=None, components=[1, 2], obs_keys=[], color_key=None
             xlim, ylim = pad(*xlim), pad(*ylim)
             g[layout_key].opts(xlim=xlim, ylim=ylim)  # other layouts are not normalized
 
-    bundled = bundle_graph(g, **bundle_kwargs, weight=None) if bundle else g.clone()
+    if bundle:
+        bundle_kwargs = {**bundle_kwargs, 'weight': None}
+        if bundle_n_jobs is not None:
+            precompute_bundles(graph[0]['start'].values, graph[0]['end'].values,
+                               [get_positions(l, graph, fingerprint=fingerprint) for l in layouts],
+                               fingerprint=fingerprint, n_jobs=bundle_n_jobs, **bundle_kwargs)
+        bundled = hv.DynamicMap(embed_bundled, kdims=kdims).opts(axiswise=True, framewise=True)
+    else:
+        bundled = g.clone()
     nodes = hv.DynamicMap(get_nodes, kdims=kdims).opts(axiswise=True, framewise=True)  # needed for datashade
 
     if subsample == 'datashade':
-        g = (datashade(bundled, normalization='linear', color_key=color_edges_by, min_alpha=128,
+        # the edges are aggregated directly from the (bundled) line segments
+        edges = hv.DynamicMap(partial(embed_edges, graph=graph, fingerprint=fingerprint), kdims=kdims)
+        g = (datashade(edges, normalization='linear', color_key=color_edges_by, min_alpha=128,
                        cmap='black' if color_edges_by is None else edge_cmap,
                        streams=[hv.streams.RangeXY(transient=True), hv.streams.PlotSize]))
         res = (g * nodes).opts(height=plot_height, width=plot_width).opts(
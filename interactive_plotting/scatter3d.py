@@ -1,6 +1,6 @@
 from interactive_plotting.utils import *
 
-from bokeh.core.properties import Any, Dict, Instance, String
+from bokeh.core.properties import Any, Dict, Instance, Int, List, String
 from bokeh.models import (
     ColumnDataSource,
     LayoutDOM,
@@ -8,23 +8,24 @@ from bokeh.models import (
     LegendItem,
     ColorBar,
     LinearColorMapper,
-    FixedTicker
+    FixedTicker,
+    CustomJS,
+    Select
 )
 from bokeh.io import save
 from bokeh.resources import CDN
-from bokeh.layouts import row
+from bokeh.layouts import row, column
 from bokeh.plotting import figure
-from bokeh.colors import RGB
-from pandas.api.types import is_categorical_dtype
+from pandas.api.types import is_categorical_dtype, is_float_dtype, is_numeric_dtype
 from anndata import AnnData
 from typing import Union, Optional, Sequence, Tuple
-from time import sleep
-from collections import defaultdict
 
 import matplotlib
 import matplotlib.cm as cm
 import numpy as np
+import pandas as pd
 import webbrowser
+import os
 import tempfile
 
 
@@ -55,34 +56,113 @@ class Surface3d(LayoutDOM):
     z = String
     color = String
 
+    # key, kind and categories of the `tooltip_{i}` columns, formatted in the browser
+    tooltip_columns = List(Dict(String, Any))
+    # if not empty, `color` contains indices into the palette
+    palette = List(String)
+    # `offset` and `scale` of the quantized coordinates
+    quantization = Dict(String, Any)
+    # end of each level of detail, the points are ordered from coarse to fine
+    lod_offsets = List(Int)
+    # delay in ms after the camera stopped before showing a finer level
+    lod_delay = Int(default=300)
+
     options = Dict(String, Any, default=_DEFAULT)
 
 
-def _to_hex_colors(values, cmap, perc=None):
-    minn, maxx = minmax(values, perc)
-    norm = matplotlib.colors.Normalize(vmin=minn, vmax=maxx, clip=True)
+def _quantize(emb, dtype):
+    if dtype == 'float32':
+        return emb.astype(np.float32), {}
+
+    minn, maxx = np.min(emb, axis=0), np.max(emb, axis=0)
+    scale = (maxx - minn) / np.iinfo(np.uint16).max
+    scale[scale == 0] = 1
+
+    return np.rint((emb - minn) / scale).astype(np.uint16), dict(offset=minn.tolist(), scale=scale.tolist())
+
+
+def _tooltip_column(values):
+    if is_numeric_dtype(values) and not is_categorical_dtype(values):
+        kind = 'float' if is_float_dtype(values) else 'int'
+        return np.asarray(values, dtype=np.float64 if kind == 'float' else np.int64), kind, None
 
-    mapper = cm.ScalarMappable(norm=norm, cmap=cmap)
+    # strings are sent as integer codes, NaNs have code `-1`
+    values = pd.Categorical(values)
 
-    return [matplotlib.colors.to_hex(mapper.to_rgba(v)) for v in values], minn, maxx
+    return values.codes.astype(np.int32), 'category', list(map(str, values.categories))
 
 
-def _mpl_to_hex_palette(cmap):
-    if isinstance(cmap, matplotlib.colors.ListedColormap):
-        rgb_cmap = (255 * cmap(range(256))).astype('int')
-        return [RGB(*tuple(rgb)).to_hex() for rgb in rgb_cmap]
+def _tooltip_html(obs, keys, sep=':'):
+    html = np.full(len(obs), '', dtype=object)
 
-    assert all(map(lambda c: matplotlib.colors.is_color_like(c), cmap)), 'Not all colors are color-like.'
+    for key in keys:
+        values = obs[key]
+        if is_float_dtype(values):
+            values = np.char.mod('%.04f', values.values)
+        else:
+            # format each distinct value only once
+            values = pd.Categorical(values)
+            categories = np.append(np.array(values.categories.astype(str), dtype=object), 'nan')
+            values = categories[values.codes]
+
+        html += f'<div><strong>{key}</strong>{sep} ' + values.astype(object) + '</div>'
+
+    return html
+
+
+def _color_codes(adata, obs, ixs, key, cmap=None, perc=None):
+    if key in obs and is_categorical_dtype(obs[key]):
+        if cmap is None:
+            colors = adata.uns.get(f'{key}_colors', None)
+            cmap = cm.tab20b if colors is None else colors
+
+        codes, palette, categories = category_codes(obs[key], cmap)
+
+        return codes, palette, dict(categories=categories)
+
+    vals = get_expression(adata, key)[ixs] if key in adata.var_names else obs[key]
+
+    cmap = cm.viridis if cmap is None else cmap
+    hex_palette = color_lut(cmap)
+    codes, minn, maxx = value_codes(vals, len(hex_palette), perc=perc)
+    # NaNs have the last index
+    palette = np.append(hex_palette.astype(object), NA_COLOR)
+
+    return codes, palette, dict(hex_palette=hex_palette.tolist(), minn=minn, maxx=maxx)
+
+
+def _create_legend(fig, palette, n_ticks=10, show_legend=True, show_cbar=True,
+                   categories=None, hex_palette=None, minn=None, maxx=None):
+    if categories is not None:
+        n_cls = len(categories)
+        _ = fig.circle([0] * n_cls, [0] * n_cls,
+                       color=list(palette[:-1]),
+                       visible=False, radius=0)
+        if not show_legend:
+            return None
 
-    return [matplotlib.colors.to_hex(c) for c in cmap]
+        return Legend(items=[
+            LegendItem(label=str(c), index=i, renderers=[_])
+            for i, c in enumerate(categories)
+        ])
 
+    _ = fig.circle(0, 0, visible=False, radius=0)
+    if not show_cbar:
+        return None
+
+    color_mapper = LinearColorMapper(palette=hex_palette, low=minn, high=maxx)
+
+    return ColorBar(color_mapper=color_mapper, ticker=FixedTicker(ticks=np.linspace(minn, maxx, n_ticks)),
+                    label_standoff=12, border_line_color=None, location=(0, 0))
 
 
 def scatter3d(adata: AnnData,
-              key: str,
+              key: Union[str, Sequence[str]],
               basis: str = 'umap',
               components: Sequence[int] = (0, 1, 2),
               steps: Union[Tuple[int, int], int] = 100,
+              lod_steps: Optional[Sequence[int]] = None,
+              lod_delay: int = 300,
               perc: Optional[Tuple[int, int]] = None,
               n_ticks: int = 10,
               vertical_ratio: float = 1,
@@ -90,26 +170,37 @@ def scatter3d(adata: AnnData,
               keep_aspect_ratio: bool = True,
               perspective: bool = True,
               tooltips: Optional[Sequence[str]] = [],
+              tooltip_mode: str = 'client',
               cmap: Optional[matplotlib.colors.ListedColormap] = None,
               dot_size_ratio: float = 0.01,
               show_legend: bool = True,
               show_cbar: bool = True,
               plot_height: Optional[int] = 1400,
-              plot_width: Optional[int] = 1400):
+              plot_width: Optional[int] = 1400,
+              compact: bool = False,
+              coord_dtype: str = 'uint16',
+              filename: Optional[str] = None):
     """
     Parameters
     ----------
     adata : :class:`anndata.AnnData`
         Annotated data object.
     key
-        Key in `adata.obs` or `adata.var_names` to color in.
+        Key in `adata.obs` or `adata.var_names` to color in. If a list of keys, the colors
+        are precomputed for each of them and the key can be switched in the browser.
     basis
         Basis to use.
     components
         Components of the basis to plot.
     steps
-        Step size when the subsampling the data.
-        Larger step size corresponds to higher density of points.
+        Number of voxels in each direction when subsampling the data, one cell is kept per occupied voxel.
+        Larger step size corresponds to higher density of points. If `None`, don't subsample.
+    lod_steps
+        Number of voxels in each direction for the coarser levels of detail, in increasing order.
+        The coarsest level is shown first and the finer ones, up to `steps`, are loaded
+        once the camera is idle or zoomed in.
+    lod_delay
+        Delay in milliseconds after the camera stopped moving before a finer level is loaded.
     perc
         Percentile by which to clip colors.
     n_ticks
@@ -124,6 +215,10 @@ def scatter3d(adata: AnnData,
         Whether to keep the perspective.
     tooltips
         Keys in `adata.obs` to visualize when hovering over cells.
+    tooltip_mode
+        How to create the tooltips. If `'client'`, the raw columns are sent once
+        and the tooltips are formatted in the browser. If `'server'`, the HTML
+        strings are created in Python.
     cmap
         Colormap to use.
     dot_size_ratio
@@ -136,6 +231,13 @@ def scatter3d(adata: AnnData,
         Height of the plot in pixels. If `None`, try getting the screen height.
     plot_width
         Width of the plot in pixels. If `None`, try getting the screen width.
+    compact
+        Whether to export the data as binary arrays. The coordinates are quantized to `coord_dtype`
+        and the colors are sent as indices into a palette. Useful for large datasets.
+    coord_dtype
+        Type of the coordinates when `compact=True`, either `'uint16'` or `'float32'`.
+    filename
+        Path where to save the HTML file. If `None`, save it to a temporary file.
 
     Returns
     -------
@@ -143,16 +245,6 @@ def scatter3d(adata: AnnData,
         Nothing, just plots in a new tab.
     """
 
-    def _wrap_as_div(row, sep=':'):
-        res = []
-        for kind, val in zip(tooltips, row):
-            if isinstance(val, float):
-                res.append(f'<div><strong>{kind}</strong>{sep} {val:.04f}</div>')
-            else:
-                res.append(f'<div><strong>{kind}</strong>{sep} {val}</div>')
-
-        return ''.join(res)
-
     basis_key = f'X_{basis}'
     assert basis_key in adata.obsm, f'Basis `{basis_key}` not found in `adata.obsm`.'
     if perc is not None:
@@ -161,57 +253,61 @@ def scatter3d(adata: AnnData,
     assert all(c >= 0 for c in components), f'All components must be non-negative, found `{min(components)}`.'
     assert max(components) < adata.obsm[basis_key].shape[-1], \
         f'Component `{max(components)}` is >= than number of components `{adata.obsm[basis_key].shape[-1]}`.'
-    assert key in adata.obs or key in adata.var_names, f'Key `{key}` not found in `adata.obs` or `adata.var_names`.'
-
-    colors = adata.uns.get(f'{key}_colors', None)
-    if steps is not None:
-        # this somehow destroys the colors
-        adata, _ = sample_unif(adata, steps, bs=basis, components=components)
-
-    data = dict(x=adata.obsm[basis_key][:, components[0]],
-                y=adata.obsm[basis_key][:, components[1]],
-                z=adata.obsm[basis_key][:, components[2]])
-
-    fig = figure(tools=[], outline_line_width=0, toolbar_location='left', disabled=True)
-    to_add = None
-
-    if key in adata.obs and is_categorical_dtype(adata.obs[key]):
-        if cmap is None:
-            cmap = colors or cm.tab20b
-
-        hex_palette = _mpl_to_hex_palette(cmap)
-
-        mapper = defaultdict(lambda: '#AAAAAA', zip(adata.obs[key].cat.categories, hex_palette))
-        colors = [str(mapper[c]) for c in adata.obs[key]]
-
-        n_cls = len(adata.obs[key].cat.categories)
-        _ = fig.circle([0] * n_cls, [0] * n_cls,
-                       color=list(mapper.values()),
-                       visible=False, radius=0)
-        if show_legend:
-            to_add = Legend(items=[
-                LegendItem(label=str(c), index=i, renderers=[_])
-                for i, c in enumerate(mapper.keys())
-            ])
+    keys = [key] if isinstance(key, str) else list(key)
+    assert len(keys), 'No keys have been specified.'
+    for key in keys:
+        assert key in adata.obs or key in adata.var_names, f'Key `{key}` not found in `adata.obs` or `adata.var_names`.'
+    assert tooltip_mode in ('client', 'server'), f'Tooltip mode must be one of `\'client\', \'server\'`, found `{tooltip_mode}`.'
+    assert coord_dtype in ('uint16', 'float32'), f'Coordinate type must be one of `\'uint16\', \'float32\'`, found `{coord_dtype}`.'
+
+    # no copy of the data, unused categories and their colors are kept
+    lod_offsets = []
+    if lod_steps is not None:
+        assert list(lod_steps) == sorted(lod_steps), f'Levels of detail must be in increasing order, found `{list(lod_steps)}`.'
+        ixs, lod_offsets = voxel_lod_ixs(adata, list(lod_steps) + [steps], bs=basis, components=components)
+        lod_offsets = lod_offsets.tolist()
+    elif steps is not None:
+        ixs = voxel_sample_ixs(adata, steps, bs=basis, components=components)
     else:
-        vals = adata.obs_vector(key) if key in adata.var_names else adata.obs[key]
-
-        cmap = cm.viridis if cmap is None else cmap
-        colors, minn, maxx = _to_hex_colors(vals, cmap, perc=perc)
-        hex_palette = _mpl_to_hex_palette(cmap)
+        ixs = slice(None)
+    obs = adata.obs.iloc[ixs]
+    emb = adata.obsm[basis_key][ixs][:, list(components)]
 
-        _ = fig.circle(0, 0, visible=False, radius=0)
+    quantization = {}
+    if compact:
+        emb, quantization = _quantize(emb, coord_dtype)
+    data = dict(x=emb[:, 0], y=emb[:, 1], z=emb[:, 2])
 
-        color_mapper = LinearColorMapper(palette=hex_palette, low=minn, high=maxx)
-        if show_cbar:
-            to_add = ColorBar(color_mapper=color_mapper, ticker=FixedTicker(ticks=np.linspace(minn, maxx, n_ticks)),
-                              label_standoff=12, border_line_color=None, location=(0, 0))
+    fig = figure(tools=[], outline_line_width=0, toolbar_location='left', disabled=True)
+    legends, palettes = [], []
+
+    for i, key in enumerate(keys):
+        codes, palette, legend = _color_codes(adata, obs, ixs, key, cmap=cmap, perc=perc)
+        legend = _create_legend(fig, palette, n_ticks=n_ticks, show_legend=show_legend, show_cbar=show_cbar, **legend)
+        if legend is not None:
+            legend.visible = i == 0
+            fig.add_layout(legend, 'left')
+        legends.append(legend)
+
+        if compact or len(keys) > 1:
+            # the colors are indices into the palette of each key
+            data['color' if len(keys) == 1 else f'color_{i}'] = codes.astype(np.uint8 if len(palette) <= 256 else np.uint16)
+            palettes.append(list(palette))
+        else:
+            data['color'] = palette[codes].tolist()
+            palettes.append([])
 
-    data['color'] = colors
     if tooltips is None:
         tooltips = adata.obs_keys()
-    if len(tooltips):
-        data['tooltip'] = adata.obs[tooltips].apply(_wrap_as_div, axis=1)
+    tooltip_columns = []
+    if len(tooltips) and tooltip_mode == 'client':
+        for i, tooltip in enumerate(tooltips):
+            data[f'tooltip_{i}'], kind, categories = _tooltip_column(obs[tooltip])
+            if compact:
+                data[f'tooltip_{i}'] = data[f'tooltip_{i}'].astype(np.float32 if kind == 'float' else np.int32)
+            tooltip_columns.append(dict(key=tooltip, kind=kind, categories=categories))
+    elif len(tooltips):
+        data['tooltip'] = _tooltip_html(obs, tooltips)
 
     source = ColumnDataSource(data=data)
     if plot_width is None or plot_height is None:
@@ -229,8 +325,10 @@ def scatter3d(adata: AnnData,
             plot_width = 1200 if plot_width is None else plot_width
             plot_height = 1200 if plot_height is None else plot_height
 
-    surface = Surface3d(x="x", y="y", z="z", color="color",
-                        data_source=source, options={**_DEFAULT,
+    surface = Surface3d(x="x", y="y", z="z", color="color" if len(keys) == 1 else "color_0",
+                        data_source=source, tooltip_columns=tooltip_columns,
+                        palette=palettes[0], quantization=quantization,
+                        lod_offsets=lod_offsets, lod_delay=lod_delay, options={**_DEFAULT,
                                                      **dict(dotSizeRatio=dot_size_ratio,
                                                             showXAxis=show_axes,
                                                             showYAxis=show_axes,
@@ -244,13 +342,10 @@ def scatter3d(adata: AnnData,
                                                             verticalRatio=vertical_ratio,
                                                             keepAspectRatio=keep_aspect_ratio,
                                                             showLegend=False,
-                                                            tooltip='tooltip' in data,
+                                                            tooltip=bool(len(tooltips)),
                                                             xCenter='50%',
                                                             yCenter='50%',
                                                             showGrid=show_axes)})
-    if to_add is not None:
-        fig.add_layout(to_add, 'left')
-
     # dirty little trick, makes plot disappear
     # ideally, one would modify the DOM in the .ts file but I'm just lazy
     fig.xgrid.visible = False
@@ -258,8 +353,25 @@ def scatter3d(adata: AnnData,
     fig.xaxis.visible = False
     fig.yaxis.visible = False
 
-    with tempfile.NamedTemporaryFile(suffix='.html') as fout:
-        path = save(row(surface, fig), fout.name, resources=CDN, title=f'Scatter3D - {key}')
-        fout.flush()
-        webbrowser.open_new_tab(path)
-        sleep(2)  # better safe than sorry
+    if filename is None:
+        # the file is kept, so that the browser doesn't race its removal
+        fd, filename = tempfile.mkstemp(suffix='.html', prefix='scatter3d_')
+        os.close(fd)
+
+    plot = row(surface, fig)
+    if len(keys) > 1:
+        select = Select(title='Key:', value=keys[0], options=keys)
+        select.js_on_change('value', CustomJS(args=dict(surface=surface, legends=legends, palettes=palettes), code='''
+            const i = cb_obj.options.indexOf(cb_obj.value);
+            legends.forEach((legend, j) => {
+                if (legend !== null) {
+                    legend.visible = i == j;
+                }
+            });
+            // only the colors of the points are updated
+            surface.setv({color: `color_${i}`, palette: palettes[i]});
+        '''))
+        plot = column(select, plot)
+
+    path = save(plot, filename, resources=CDN, title=f'Scatter3D - {", ".join(keys)}')
+    webbrowser.open_new_tab(path)
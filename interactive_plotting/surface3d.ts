@@ -6,15 +6,24 @@ declare namespace vis {
   class Graph3d {
     constructor(el: HTMLElement, data: object, OPTIONS: object)
     setData(data: vis.DataSet): void
+    redraw(): void
+    on(event: string, callback: (event: any) => void): void
   }
 
   class DataSet {
-    add(data: unknown): void
+    length: number
+    add(data: unknown[]): void
+    update(data: unknown[]): void
+    remove(ids: number[]): void
   }
 }
 
-function _tooltip(obj: {x: number, y: number, z: number, data: {tooltip: string}}) {
-    return obj.data["tooltip"];
+type TooltipColumn = {key: string, kind: string, categories: string[] | null}
+
+type Point = {x: number, y: number, z: number, data: {index: number}}
+
+function _tooltip(obj: Point) {
+    return (obj.data as any)["tooltip"];
 }
 
 const OPTIONS = {
@@ -40,46 +49,187 @@ export class Surface3dView extends HTMLBoxView {
   model: Surface3d
 
   private _graph: vis.Graph3d
+  private _data: vis.DataSet
+  // columns from which `_data` was created, to find out what changed
+  private _columns: {[key: string]: unknown} = {}
+  // current level of detail, the first `lod_offsets[_level]` points are shown
+  private _level: number = 0
+  private _idle: number | null = null
 
   render(): void {
     super.render()
     if (this.model.options["tooltip"]) {  // we want to show tooltips
-        this.model.options["tooltip"] = _tooltip
+        this.model.options["tooltip"] = ("tooltip" in this.model.data_source.data) ? _tooltip
+                                        : (obj: Point) => this.format_tooltip(obj.data.index)
+    }
+    this._data = this.get_data()
+    this._graph = new vis.Graph3d(this.el, this._data, this.model.options)
+
+    if (this.model.lod_offsets.length > 1) {
+      this._graph.on("cameraPositionChange", (camera) => this.on_camera_change(camera))
+      this.schedule_refine()
     }
-    this._graph = new vis.Graph3d(this.el, this.get_data(), this.model.options)
+  }
+
+  n_points(): number {
+    const offsets = this.model.lod_offsets
+    return offsets.length > 0 ? offsets[this._level] : this.model.data_source.get_length()!
+  }
+
+  on_camera_change(camera: {distance: number}): void {
+    // while moving, show only the coarser levels, unless zoomed in
+    const distance = (this.model.options["cameraPosition"] as {distance: number}).distance
+    const level = Math.min(Math.max(Math.floor(Math.log2(distance / camera.distance)), 0),
+                           this.model.lod_offsets.length - 1)
+    if (level < this._level)
+      this.set_level(level)
+    this.schedule_refine()
+  }
+
+  schedule_refine(): void {
+    if (this._idle != null)
+      clearTimeout(this._idle)
+
+    this._idle = setTimeout(() => {
+      this._idle = null
+      if (this._level + 1 < this.model.lod_offsets.length) {
+        this.set_level(this._level + 1)
+        this.schedule_refine()
+      }
+    }, this.model.lod_delay)
+  }
+
+  set_level(level: number): void {
+    const start = this.n_points()
+    this._level = level
+    const end = this.n_points()
+
+    // the levels are nested, only the difference is added or removed
+    if (end > start)
+      this._data.add(this.make_points(start, end))
+    else if (end < start)
+      this._data.remove(Array.from({length: start - end}, (_, i) => end + i))
   }
 
   connect_signals(): void {
     super.connect_signals()
-    this.connect(this.model.data_source.change, () => this._graph.setData(this.get_data()))
+    this.connect(this.model.data_source.change, () => this.update_data())
+    this.connect(this.model.data_source.patching, (indices) => this.update_points(indices, true))
+    // switching between the precomputed color columns
+    this.connect(this.model.properties.color.change, () => this.update_points())
+    this.connect(this.model.properties.palette.change, () => this.update_points())
+  }
+
+  update_data(): void {
+    const source = this.model.data_source
+    const changed = Object.keys(source.data).filter((column) => source.data[column] !== this._columns[column])
+    const coords = [this.model.x, this.model.y, this.model.z]
+
+    if (this.n_points() != this._data.length || changed.some((column) => coords.includes(column))) {
+      // the points moved, the scene has to be recreated
+      this._data = this.get_data()
+      this._graph.setData(this._data)
+    } else if (changed.length > 0) {
+      // only the colors or the tooltips changed
+      this.update_points()
+    }
+  }
+
+  update_points(indices?: number[], with_coords: boolean = false): void {
+    // patch the points in place, without recreating the scene
+    const source = this.model.data_source
+    const colors = this.get_colors()
+    const coords = with_coords ? [0, 1, 2].map((i) => this.get_coords([this.model.x, this.model.y, this.model.z][i], i)) : null
+    const has_tooltip = "tooltip" in source.data
+    // points of the finer levels that are not shown are created once needed
+    if (indices != null)
+      indices = indices.filter((i) => i < this.n_points())
+    const n = indices != null ? indices.length : this.n_points()
+
+    const points: object[] = new Array(n)
+    for (let j = 0; j < n; j++) {
+      const i = indices != null ? indices[j] : j
+      const point: {[key: string]: unknown} = {id: i, style: colors[i]}
+      if (coords != null)
+        [point.x, point.y, point.z] = coords.map((values) => values[i])
+      if (has_tooltip)
+        point.tooltip = source.data["tooltip"][i]
+      points[j] = point
+    }
+
+    this._data.update(points)
+    this._columns = {...source.data}
+    this._graph.redraw()
+  }
+
+  format_tooltip(i: number): string {
+    // the raw columns are only formatted for the hovered point
+    const source = this.model.data_source
+    const res: string[] = []
+
+    this.model.tooltip_columns.forEach((column, j) => {
+      const value = source.data[`tooltip_${j}`][i] as number
+      let text: string
+      if (column.kind == "category")
+        text = value < 0 ? "nan" : column.categories![value]
+      else if (column.kind == "float")
+        text = (value == null || isNaN(value)) ? "nan" : value.toFixed(4)
+      else
+        text = `${value}`
+      res.push(`<div><strong>${column.key}</strong>: ${text}</div>`)
+    })
+
+    return res.join("")
   }
 
   get_data(): vis.DataSet {
     const data = new vis.DataSet()
+    // adding the points one by one triggers an event for each of them
+    data.add(this.make_points(0, this.n_points()))
+    this._columns = {...this.model.data_source.data}
+
+    return data
+  }
+
+  make_points(start: number, end: number): object[] {
     const source = this.model.data_source
+    const has_tooltip = "tooltip" in source.data
+    const [x, y, z] = [0, 1, 2].map((i) => this.get_coords([this.model.x, this.model.y, this.model.z][i], i))
+    const colors = this.get_colors()
 
-    if ("tooltip" in source.data) {
-        for (let i = 0; i < source.get_length()!; i++) {
-          data.add({
-            x: source.data[this.model.x][i],
-            y: source.data[this.model.y][i],
-            z: source.data[this.model.z][i],
-            style: source.data[this.model.color][i],
-            tooltip: source.data["tooltip"][i]
-          })
-        }
-    } else {
-        for (let i = 0; i < source.get_length()!; i++) {
-          data.add({
-            x: source.data[this.model.x][i],
-            y: source.data[this.model.y][i],
-            z: source.data[this.model.z][i],
-            style: source.data[this.model.color][i],
-          })
-        }
+    const points: object[] = new Array(end - start)
+    for (let i = start; i < end; i++) {
+      const point: {[key: string]: unknown} = {id: i, x: x[i], y: y[i], z: z[i], style: colors[i], index: i}
+      if (has_tooltip)
+        point.tooltip = source.data["tooltip"][i]
+      points[i - start] = point
     }
 
-    return data
+    return points
+  }
+
+  get_coords(column: string, dim: number): ArrayLike<number> {
+    const values = this.model.data_source.data[column] as ArrayLike<number>
+    const {offset, scale} = this.model.quantization as {offset?: number[], scale?: number[]}
+    if (offset == null || scale == null)
+      return values
+
+    // dequantize the coordinates
+    const res = new Float64Array(values.length)
+    for (let i = 0; i < values.length; i++)
+      res[i] = offset[dim] + values[i] * scale[dim]
+
+    return res
+  }
+
+  get_colors(): ArrayLike<string> {
+    const values = this.model.data_source.data[this.model.color] as ArrayLike<any>
+    const palette = this.model.palette
+    if (palette.length == 0)
+      return values
+
+    // colors are indices into the palette
+    return Array.from(values as ArrayLike<number>, (code) => palette[code])
   }
 }
 
@@ -91,6 +241,11 @@ export namespace Surface3d {
     y: p.Property<string>
     z: p.Property<string>
     color: p.Property<string>
+    tooltip_columns: p.Property<TooltipColumn[]>
+    palette: p.Property<string[]>
+    quantization: p.Property<{[key: string]: unknown}>
+    lod_offsets: p.Property<number[]>
+    lod_delay: p.Property<number>
     data_source: p.Property<ColumnDataSource>
     options: p.Property<{[key: string]: unknown}>
   }
@@ -115,6 +270,11 @@ export class Surface3d extends HTMLBox {
       y:           [ p.String           ],
       z:           [ p.String           ],
       color:       [ p.String           ],
+      tooltip_columns: [ p.Array,   []    ],
+      palette:     [ p.Array,   []      ],
+      quantization: [ p.Any,    {}      ],
+      lod_offsets: [ p.Array,   []      ],
+      lod_delay:   [ p.Number,  300     ],
       data_source: [ p.Instance         ],
       options:     [ p.Any,     OPTIONS ]
     })
@@ -1,21 +1,17 @@
 #!/usr/bin/env python3
 
-from functools import wraps
-from collections import Iterable
+from functools import wraps, lru_cache
+from collections import OrderedDict as odict
+from collections.abc import Iterable
 from inspect import signature
-from sklearn.neighbors import NearestNeighbors
 from scipy.sparse import issparse
 
-import anndata
-import matplotlib.colors as colors
-import scanpy as sc
 import numpy as np
 import pandas as pd
-import networkx as nx
-import panel as pn
 import re
 import itertools
 import warnings
+import weakref
 
 
 NO_SUBSAMPLE = (None, 'none')
@@ -24,60 +20,282 @@ ALL_SUBSAMPLING_STRATEGIES = NO_SUBSAMPLE + SUBSAMPLING_STRATEGIES
 
 SUBSAMPLE_THRESH = 30_000
 HOLOMAP_THRESH = 50
+SAMPLING_CACHE_BYTES = 64 * 1024 ** 2  # for the subsampled indices
+# column-oriented copies of sparse expression matrices, see `use_expression_cache`
+EXPRESSION_CACHE = {'enabled': False, 'max_bytes': 1024 ** 3, 'chunk_size': 1024}
+LAYOUT_CACHE = {'max_size': 64, 'cache_dir': None}
+BUNDLE_CACHE_SIZE = 16
 OBSM_SEP = ':'
+NA_COLOR = '#AAAAAA'
+LUT_SIZE = 256  # number of colors sampled from a colormap
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
 
 CBW = 10  # colorbar width
 BS_PAT = re.compile('^X_(.+)')
 
-# for graph
-DEFAULT_LAYOUTS = {l.split('_layout')[0]:getattr(nx.layout, l)
-                   for l in dir(nx.layout) if l.endswith('_layout')}
-DEFAULT_LAYOUTS.pop('bipartite')
-DEFAULT_LAYOUTS.pop('rescale')
-DEFAULT_LAYOUTS.pop('spectral')
 
+def __getattr__(name):
+    # `DEFAULT_LAYOUTS` requires `networkx`, which is only imported on first access
+    if name == 'DEFAULT_LAYOUTS':
+        return get_default_layouts()
 
-class SamplingLazyDict(dict):
+    raise AttributeError(f'module `{__name__}` has no attribute `{name}`')
 
-    def __init__(self, adata, subsample, *args, callback_kwargs={}, **kwargs):
-        super().__init__(*args, **kwargs)
+
+@lru_cache(maxsize=1)
+def get_default_layouts():
+    '''
+    Get the graph layouts from `networkx` and the `'multilevel'` layout, see `multilevel_layout`.
+
+    Returns
+    --------
+    layouts: Dict[Str, Callable]
+        mapping of layout names to their functions
+    '''
+
+    import networkx as nx
+
+    layouts = {l.split('_layout')[0]:getattr(nx.layout, l)
+               for l in dir(nx.layout) if l.endswith('_layout')}
+    layouts.pop('bipartite')
+    layouts.pop('rescale')
+    layouts.pop('spectral')
+    layouts['multilevel'] = multilevel_layout
+
+    return layouts
+
+
+_OBJECT_CACHE = {}
+_LAYOUT_CACHE = odict()
+_BUNDLE_CACHE = odict()
+
+
+def get_object_cache(obj):
+    '''
+    Get a dictionary for caching values derived from an object.
+
+    The dictionary is bound to the lifetime of the object and
+    is removed once the object is garbage collected.
+
+    Params
+    --------
+    obj: Object
+        weak-referenceable object, such as `anndata.AnnData`
+
+    Returns
+    --------
+    cache: Dict
+        cache associated with `obj`
+    '''
+
+    key = id(obj)
+    ref, cache = _OBJECT_CACHE.get(key, (None, None))
+    if ref is None or ref() is not obj:
+        ref, cache = weakref.ref(obj), {}
+        _OBJECT_CACHE[key] = (ref, cache)
+        weakref.finalize(obj, _OBJECT_CACHE.pop, key, None)
+
+    return cache
+
+
+class SamplingLazyDict:
+    '''
+    Lazily computes the subsampled indices for each `(basis, components)` key.
+
+    Only the index arrays are cached, the (maybe subsampled) `anndata.AnnData`
+    is created as a view on access. Least recently used indices are evicted
+    once their total size exceeds `max_bytes`.
+    '''
+
+    def __init__(self, adata, subsample, callback_kwargs={}, max_bytes=SAMPLING_CACHE_BYTES):
         self.adata = adata
         self.callback_kwargs = callback_kwargs
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = odict()
 
         if subsample == 'uniform':
-            self.callback = sample_unif
+            self.callback = sample_unif_ixs
         elif subsample == 'density':
-            self.callback = sample_density
+            self.callback = sample_density_ixs
         else:
-            ixs = list(range(adata.n_obs))
-            self.callback = lambda *args, **kwargs: (adata, ixs)
+            self.callback = None
+            self._all_ixs = np.arange(adata.n_obs)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def keys(self):
+        return self._cache.keys()
+
+    def cache_info(self):
+        '''
+        Get the cache statistics.
+
+        Returns
+        --------
+        info: Dict
+            number of hits, misses, cached keys and their size in bytes
+        '''
+
+        return dict(hits=self.hits, misses=self.misses, size=len(self), nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+    def get_indices(self, key):
+        '''
+        Get the subsampled indices for a key.
+
+        Params
+        --------
+        key: Tuple[Str, Tuple[Int, ...]]
+            basis and its components
+
+        Returns
+        --------
+        ixs: np.ndarray
+            sorted indices of the subsampled observations
+        '''
+
+        if self.callback is None:
+            return self._all_ixs
+
+        bs, comps = key
+        for k in (key, (bs, comps[::-1])):
+            if k in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(k)
+                return self._cache[k]
+
+        self.misses += 1
+        ixs = np.asarray(self.callback(self.adata, bs=bs, components=comps, **self.callback_kwargs))
+        self._cache[key] = ixs
+        self.nbytes += ixs.nbytes
+
+        # always keep the most recent one, even if it's over the budget
+        while self.nbytes > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        return ixs
 
     def __getitem__(self, key):
-        if key not in self:
-            bs, comps = key
-            rev_comps = comps[::-1]
+        ixs = self.get_indices(key)
+        if self.callback is None:
+            return self.adata, ixs
+
+        return self.adata[ixs, :], ixs
+
+
+class PseudotimeEngine:
+    '''
+    Diffusion pseudotime for arbitrary root cells, same as `sc.tl.dpt`.
+
+    The diffusion map (`adata.obsm['X_diffmap']` and `adata.uns['diffmap_evals']`),
+    computed using `sc.tl.diffmap` if not present, is rescaled only once, computing the pseudotime for a new root cell
+    then only requires the distances of all the cells to the root.
+    The results are cached in a LRU keyed by the root cell index.
+    '''
+
+    def __init__(self, adata, n_dcs=10, max_roots=32):
+        if 'X_diffmap' not in adata.obsm.keys() or 'diffmap_evals' not in adata.uns.keys():
+            # computed once and stored in `adata`, as in `sc.tl.dpt`
+            import scanpy as sc
+
+            sc.tl.diffmap(adata, **({} if n_dcs is None else dict(n_comps=n_dcs)))
+        assert max_roots > 0, f'`max_roots` must be positive, found `{max_roots}`.'
 
-            if (bs, rev_comps) in self.keys():
-                res, ixs = self[bs, rev_comps]
-            else:
-                res, ixs = self.callback(self.adata, bs=bs, components=comps, **self.callback_kwargs)
+        evals = np.asarray(adata.uns['diffmap_evals'])
+        assert n_dcs is None or n_dcs <= len(evals), \
+            f'`n_dcs={n_dcs}` is larger than the number of diffusion components `{len(evals)}`.'
+        evals = evals[:n_dcs]
 
-            self[key] = res, ixs
+        # the stationary state(s) are not rescaled, as in `sc.tl.dpt`
+        weights = np.ones_like(evals, dtype=np.float64)
+        mask = evals < 0.9994
+        weights[mask] = evals[mask] / (1 - evals[mask])
+        self._basis = np.asarray(adata.obsm['X_diffmap'][:, :len(evals)], dtype=np.float64) * weights
 
-            return res, ixs
+        self._labels = None
+        conn = PseudotimeEngine._get_connectivities(adata)
+        if conn is not None and issparse(conn):
+            from scipy.sparse.csgraph import connected_components
 
-        return super().__getitem__(key)
+            n_comps, labels = connected_components(conn)
+            if n_comps > 1:
+                self._labels = labels
+
+        self.max_roots = max_roots
+        self.hits = 0
+        self.misses = 0
+        self._cache = odict()
+
+    @staticmethod
+    def _get_connectivities(adata):
+        if hasattr(adata, 'obsp') and 'connectivities' in adata.obsp.keys():
+            return adata.obsp['connectivities']
+
+        return adata.uns.get('neighbors', {}).get('connectivities', None)
+
+    def __call__(self, root):
+        '''
+        Compute the pseudotime.
+
+        Params
+        --------
+        root: Int
+            index of the root cell
+
+        Returns
+        --------
+        pseudotime: np.ndarray
+            read-only array of pseudotime values, cells
+            unreachable from the root have a value of `np.inf`
+        '''
+
+        root = int(root)
+        if root in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(root)
+            return self._cache[root]
+
+        self.misses += 1
+        pseudotime = np.sqrt(np.sum((self._basis - self._basis[root]) ** 2, axis=1))
+        if self._labels is not None:
+            pseudotime[self._labels != self._labels[root]] = np.inf
+
+        finite = pseudotime[pseudotime < np.inf]
+        maxx = np.max(finite) if len(finite) else 0
+        if maxx > 0:
+            pseudotime /= maxx
+        pseudotime.setflags(write=False)
+
+        self._cache[root] = pseudotime
+        if len(self._cache) > self.max_roots:
+            self._cache.popitem(last=False)
+
+        return pseudotime
 
 
 def to_hex_palette(palette, normalize=True):
     """
     Converts matplotlib color array to hex strings
     """
+    import matplotlib.colors as colors
+
     if not isinstance(palette, np.ndarray):
         palette = np.array(palette)
 
     if isinstance(palette[0], str):
-        assert all(map(colors.is_color_like, palette)), 'Not all strings are color like.'
+        # only the distinct colors need to be validated
+        assert all(map(colors.is_color_like, np.unique(palette))), 'Not all strings are color like.'
         return palette
 
     if normalize:
@@ -85,9 +303,200 @@ def to_hex_palette(palette, normalize=True):
         # normalize to [0, 1]
         palette = (palette - minn) / (np.max(palette) - minn)
 
+    if palette.ndim == 2 and palette.shape[1] in (3, 4):
+        return list(rgba_to_hex(palette))
+
     return [colors.to_hex(c) if colors.is_color_like(c) else c for c in palette]
 
 
+def rgba_to_hex(rgba):
+    '''
+    Convert RGB(A) colors to hex strings in one vectorized pass.
+
+    Params
+    --------
+    rgba: np.ndarray
+        array of shape `(n, 3)` or `(n, 4)` with values in `[0, 1]`,
+        the alpha channel is ignored
+
+    Returns
+    --------
+    hex_colors: np.ndarray
+        array of shape `(n,)` of hex strings, such as `'#1f77b4'`
+    '''
+    rgba = np.asarray(rgba, dtype=np.float64)
+    assert rgba.ndim == 2 and rgba.shape[1] in (3, 4), f'Expected array of shape `(n, 3)` or `(n, 4)`, found `{rgba.shape}`.'
+
+    rgb = np.clip(np.rint(rgba[:, :3] * 255), 0, 255).astype(np.uint8)
+    # write the ASCII characters directly and reinterpret each row as 1 string
+    chars = np.empty((len(rgb), 7), dtype=np.uint8)
+    chars[:, 0] = ord('#')
+    chars[:, 1::2] = _HEX_DIGITS[rgb >> 4]
+    chars[:, 2::2] = _HEX_DIGITS[rgb & 15]
+
+    return chars.view('S7').ravel().astype('U7')
+
+
+def color_lut(cmap, n_colors=LUT_SIZE):
+    '''
+    Create a color lookup table.
+
+    Params
+    --------
+    cmap: Union[matplotlib.colors.Colormap, List[Str], np.ndarray]
+        colormap or a list of colors
+    n_colors: Int, optional (default: `256`)
+        number of colors to sample from a colormap,
+        lists of colors are used as they are
+
+    Returns
+    --------
+    lut: np.ndarray
+        array of shape `(n_colors,)` of hex strings
+    '''
+    import matplotlib.colors as colors
+
+    if isinstance(cmap, colors.Colormap):
+        return rgba_to_hex(cmap(np.linspace(0, 1, n_colors)))
+
+    cmap = np.asarray(cmap)
+    if cmap.dtype.kind in ('U', 'S', 'O'):
+        uniq, inv = np.unique(cmap.astype(str), return_inverse=True)
+        assert all(map(colors.is_color_like, uniq)), 'Not all colors are color-like.'
+        return rgba_to_hex(colors.to_rgba_array(uniq))[inv]
+
+    return rgba_to_hex(cmap)
+
+
+def value_codes(values, n_colors=LUT_SIZE, perc=None, vmin=None, vmax=None):
+    '''
+    Bin continuous values into lookup table indices.
+
+    Params
+    --------
+    values: Union[np.ndarray, pd.Series, List]
+        values to bin
+    n_colors: Int, optional (default: `256`)
+        size of the lookup table
+    perc: Union[List[Float], Tuple[Float]], optional (default: `None`)
+        clip the values by the percentiles
+    vmin, vmax: Float, optional (default: `None`)
+        range of the values, if `None`, it's computed
+
+    Returns
+    --------
+    (codes, minn, maxx): Tuple[np.ndarray, Float, Float]
+        indices in `[0, n_colors)`, NaNs have index `n_colors`,
+        and the range used for the normalization
+    '''
+    values = np.asarray(values, dtype=np.float64)
+
+    minn, maxx = minmax(values, perc)
+    minn = minn if vmin is None else vmin
+    maxx = maxx if vmax is None else vmax
+
+    # equally sized bins, as in `matplotlib.colors.Colormap`
+    scale = n_colors / (maxx - minn) if maxx > minn else 0
+    with np.errstate(invalid='ignore'):
+        codes = np.clip((values - minn) * scale, 0, n_colors - 1)
+    codes[np.isnan(codes)] = n_colors
+
+    return codes.astype(np.intp), minn, maxx
+
+
+def map_values(values, lut, perc=None, vmin=None, vmax=None, na_color=NA_COLOR):
+    '''
+    Map continuous values to colors using a lookup table.
+
+    Params
+    --------
+    values: Union[np.ndarray, pd.Series, List]
+        values to map
+    lut: Union[np.ndarray, matplotlib.colors.Colormap]
+        lookup table of hex colors, see `color_lut`,
+        or a colormap from which it is created
+    perc: Union[List[Float], Tuple[Float]], optional (default: `None`)
+        clip the values by the percentiles
+    vmin, vmax: Float, optional (default: `None`)
+        range of the values, if `None`, it's computed
+    na_color: Str, optional (default: `'#AAAAAA'`)
+        color for the NaN values
+
+    Returns
+    --------
+    (colors, minn, maxx): Tuple[np.ndarray, Float, Float]
+        hex colors and the range used for the normalization
+    '''
+    lut = np.asarray(color_lut(lut) if not isinstance(lut, (np.ndarray, list, tuple)) else lut)
+    codes, minn, maxx = value_codes(values, len(lut), perc=perc, vmin=vmin, vmax=vmax)
+
+    if np.any(codes == len(lut)):
+        lut = np.append(lut.astype(object), na_color)
+
+    return lut[codes], minn, maxx
+
+
+def category_codes(values, palette, categories=None, na_color=NA_COLOR):
+    '''
+    Get the integer category codes and the matching lookup table.
+
+    Params
+    --------
+    values: Union[pd.Series, pd.Categorical, np.ndarray, List]
+        categorical values
+    palette: Union[List[Str], np.ndarray, matplotlib.colors.Colormap]
+        colors of the categories, in order,
+        categories without a color get `na_color`
+    categories: List, optional (default: `None`)
+        categories, if `None`, use the categories of `values`
+    na_color: Str, optional (default: `'#AAAAAA'`)
+        color for the missing values and for categories without a color
+
+    Returns
+    --------
+    (codes, lut, categories): Tuple[np.ndarray, np.ndarray, pd.Index]
+        non-negative indices into `lut`, the hex colors of the categories
+        followed by `na_color` for the missing values, and the categories
+    '''
+    import matplotlib.colors as colors
+
+    values = pd.Categorical(values, categories=categories)
+    categories = values.categories
+    # listed colormaps, such as `tab20`, already are categorical palettes
+    n_colors = palette.N if isinstance(palette, colors.ListedColormap) else len(categories)
+    palette = list(color_lut(palette, n_colors))[:len(categories)]
+    # categories past the palette, as well as NaNs (code `-1`), are the last entry
+    lut = np.array(palette + [na_color] * (len(categories) - len(palette) + 1), dtype=object)
+
+    return np.where(values.codes < 0, len(lut) - 1, values.codes), lut, categories
+
+
+def map_categories(values, palette, categories=None, na_color=NA_COLOR):
+    '''
+    Map categorical values to colors using integer category codes.
+
+    Params
+    --------
+    values: Union[pd.Series, pd.Categorical, np.ndarray, List]
+        categorical values to map
+    palette: Union[List[Str], np.ndarray, matplotlib.colors.Colormap]
+        colors of the categories, in order,
+        categories without a color get `na_color`
+    categories: List, optional (default: `None`)
+        categories, if `None`, use the categories of `values`
+    na_color: Str, optional (default: `'#AAAAAA'`)
+        color for the missing values and for categories without a color
+
+    Returns
+    --------
+    (colors, mapping): Tuple[np.ndarray, odict]
+        hex colors of the values and a mapping of categories to colors
+    '''
+    codes, lut, categories = category_codes(values, palette, categories=categories, na_color=na_color)
+
+    return lut[codes], odict(zip(categories, lut[:-1]))
+
+
 def pad(minn, maxx, padding=0.05):
     if minn > maxx:
         maxx, minn = minn, maxx
@@ -187,7 +596,7 @@ def minmax(component, perc=None, is_sorted=False):
     '''
     if perc is not None:
         assert len(perc) == 2, 'Percentile must be of length 2.'
-        component = np.clip(component, *np.percentile(component, sorted(perc)))
+        component = np.clip(component, *np.nanpercentile(component, sorted(perc)))
 
     return (np.nanmin(component), np.nanmax(component)) if not is_sorted else (component[0], component[-1])
 
@@ -371,6 +780,8 @@ def wrap_as_panel(fn):
 
     @wraps(fn)
     def inner(*args, **kwargs):
+        import panel as pn
+
         reverse = kwargs.pop('reverse', True)
         res = fn(*args, **kwargs)
         if res is None:
@@ -407,6 +818,8 @@ def wrap_as_col(fn):
 
     @wraps(fn)
     def inner(*args, **kwargs):
+        import panel as pn
+
         reverse = kwargs.pop('reverse', True)
         res = fn(*args, **kwargs)
         if res is None:
@@ -422,6 +835,104 @@ def wrap_as_col(fn):
     return inner
 
 
+class KeyResolver:
+    '''
+    Hash index of the keys in `adata.obs`, `adata.obsm` and `adata.var_names`.
+    '''
+
+    def __init__(self, adata):
+        self.fingerprint = KeyResolver.get_fingerprint(adata)
+        obs_keys, obsm_keys, var_names = self.fingerprint
+        self.n_vars = len(var_names)
+
+        self._index = {
+            'obs': dict(zip(obs_keys, range(len(obs_keys)))),
+            'obsm': dict(zip(obsm_keys, range(len(obsm_keys)))),
+            # reversed, so that the first occurrence is kept for duplicated names
+            'var_names': dict(zip(var_names[::-1], range(len(var_names) - 1, -1, -1)))
+        }
+
+    @staticmethod
+    def get_fingerprint(adata):
+        obs = getattr(adata, 'obs', None)
+        obsm = getattr(adata, 'obsm', None)
+
+        return (tuple(obs.columns) if obs is not None else (),
+                tuple(obsm.keys()) if obsm is not None else (),
+                adata.var_names)
+
+    def is_valid(self, adata):
+        obs_keys, obsm_keys, var_names = KeyResolver.get_fingerprint(adata)
+
+        # `pd.Index` is immutable, a new one is created when the names are changed
+        return obs_keys == self.fingerprint[0] and obsm_keys == self.fingerprint[1] and \
+            var_names is self.fingerprint[2] and len(var_names) == self.n_vars
+
+    def find(self, haystack, key):
+        '''
+        Find the position of a key.
+
+        Params
+        --------
+        haystack: Str
+            one of `'obs'`, `'obsm'`, `'var_names'`
+        key: Str
+            key to search for
+
+        Returns
+        --------
+        pos: Union[Int, NoneType]
+            position of the key or `None` if not found
+        '''
+
+        assert haystack in self._index, f'Unknown haystack `{haystack}`, expected one of `{list(self._index.keys())}`.'
+
+        try:
+            return self._index[haystack].get(key, None)
+        except TypeError:  # unhashable
+            return None
+
+
+def _keeps_all_vars(view, parent):
+    # reordered genes would be resolved to their positions in the parent
+    vidx = getattr(view, '_vidx', None)
+    if isinstance(vidx, slice):
+        return range(*vidx.indices(parent.n_vars)) == range(parent.n_vars)
+
+    return view.var_names is parent.var_names
+
+
+def get_resolver(adata):
+    '''
+    Get the (cached) key resolver of an `anndata.AnnData` object.
+
+    The resolver is rebuilt when the keys of `adata.obs`, `adata.obsm` or `adata.var_names` change.
+    Views which only subset the observations share the resolver of their parent.
+
+    Params
+    --------
+    adata: Union[anndata.AnnData, anndata.Raw]
+        anndata object or its `.raw` attribute
+
+    Returns
+    --------
+    resolver: KeyResolver
+        resolver for `adata`
+    '''
+
+    parent = getattr(adata, '_adata_ref', None) if getattr(adata, 'is_view', False) else None
+    if parent is not None and _keeps_all_vars(adata, parent):
+        # the keys are the same, don't rebuild the index for every view
+        adata = parent
+
+    cache = get_object_cache(adata)
+    resolver = cache.get('resolver', None)
+    if resolver is None or not resolver.is_valid(adata):
+        resolver = cache['resolver'] = KeyResolver(adata)
+
+    return resolver
+
+
 def get_data(adata, needle, ignore_after=OBSM_SEP, haystacks=['obs', 'obsm', 'var_names']):
     f'''
     Search for a needle in multiple haystacks.
@@ -445,16 +956,18 @@ def get_data(adata, needle, ignore_after=OBSM_SEP, haystacks=['obs', 'obsm', 'va
         the found object and whether it's categorical
     '''
 
+    resolver = get_resolver(adata)
+
     for haystack in haystacks:
-        obj = getattr(adata, haystack)
         if ignore_after in needle and haystack == 'obsm':
             k, ix = needle.split(ignore_after)
             ix = int(ix)
         else:
             k, ix = needle, None
 
-        if k in obj:
-            res = obj[k] if haystack != 'var_names' else adata.obs_vector(k)
+        pos = resolver.find(haystack, k)
+        if pos is not None:
+            res = getattr(adata, haystack)[k] if haystack != 'var_names' else get_expression(adata, pos)
             if ix is not None:
                 assert res.ndim == 2, f'`adata.{haystack}[{k}]` must have a dimension of 2, found `{res.dim}`.'
                 assert res.shape[-1] > ix, f'Index `{ix}` out of bounds for `adata.{haystack}[{k}]` of shape `{res.shape}`.'
@@ -481,106 +994,579 @@ def get_all_obsm_keys(adata, ixs):
                                           for ix in ixs))
 # based on:
 # https://github.com/velocyto-team/velocyto-notebooks/blob/master/python/DentateGyrus.ipynb
-def sample_unif(adata, steps, bs='umap', components=(0, 1)):
-    if not isinstance(steps, (tuple, list)):
-        steps = [steps] * len(components)
+def sample_unif_ixs(adata, steps, bs='umap', components=(0, 1)):
+    '''
+    Uniformly subsample the embedding.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    steps: Union[Int, Tuple[Int, ...]]
+        number of grid steps in each direction
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm` without the `'X_'` prefix
+    components: Tuple[Int, ...], optional (default: `(0, 1)`)
+        components of the basis to use
+
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the subsampled observations
+    '''
 
     assert len(components)
     assert min(components) >= 0
 
-    embedding = adata.obsm[f'X_{bs}'][:, components]
-    n_dim = len(components)
+    return grid_sample(adata.obsm[f'X_{bs}'][:, components], steps)
 
-    grs = []
-    for i in range(n_dim):
-        m, M = np.min(embedding[:, i]), np.max(embedding[:, i])
-        m = m - 0.025 * np.abs(M - m)
-        M = M + 0.025 * np.abs(M - m)
-        gr = np.linspace(m, M, num=steps[i])
-        grs.append(gr)
 
-    meshes_tuple = np.meshgrid(*grs)
-    gridpoints_coordinates = np.vstack([i.flat for i in meshes_tuple]).T
+def grid_sample(embedding, steps):
+    '''
+    Keep one observation per occupied cell of a regular grid.
 
-    nn = NearestNeighbors()
-    nn.fit(embedding)
-    dist, ixs = nn.kneighbors(gridpoints_coordinates, 1)
+    Each observation is hashed to its closest grid point and for every
+    occupied grid point, the closest observation is kept.
 
-    diag_step_dist = np.linalg.norm([grs[dim_i][1] - grs[dim_i][0] for dim_i in range(n_dim)])
-    min_dist = diag_step_dist / 2
+    Params
+    --------
+    embedding: np.ndarray
+        array of shape `(n_obs, n_dim)`
+    steps: Union[Int, Tuple[Int, ...]]
+        number of grid steps in each direction
 
-    ixs = ixs[dist < min_dist]
-    ixs = np.unique(ixs)
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the subsampled observations
+    '''
 
-    return adata[ixs, :].copy(), ixs
+    embedding = np.asarray(embedding, dtype=np.float64)
+    n_obs, n_dim = embedding.shape
+    if not isinstance(steps, (tuple, list, np.ndarray)):
+        steps = [steps] * n_dim
 
+    assert len(steps) == n_dim, f'Expected `{n_dim}` steps, found `{len(steps)}`.'
+    assert all(s > 1 for s in steps), f'All steps must be `> 1`, found `{list(steps)}`.'
 
-def sample_density(adata, size, bs='umap', seed=None, components=[0, 1]):
-    if size >= adata.n_obs:
-        return adata
+    if n_obs == 0:
+        return np.array([], dtype=np.int64)
 
-    if components[0] == components[1]:
-        tmp = pd.DataFrame(np.ones(adata.n_obs) / adata.n_obs, columns=['prob_density'])
-    else:
-        # should be unique, using it only once since we cache the results
-        # we don't need to add the components
-        key_added =  f'{bs}_density_ipl_tmp'
-        remove_key = False  # we may be operating on original object, keep it clean
-        if key_added not in adata.obs.keys():
-            sc.tl.embedding_density(adata, bs, key_added=key_added)
-            remove_key = True
-        tmp = pd.DataFrame(np.exp(adata.obs[key_added]) / np.sum(np.exp(adata.obs[key_added])))
-        tmp.rename(columns={key_added: 'prob_density'}, inplace=True)
-        if remove_key:
-            del adata.obs[key_added]
+    codes, dist = _grid_cells(embedding, steps)
 
-    state = np.random.RandomState(seed)
-    ixs = sorted(state.choice(range(adata.n_obs), size=size, p=tmp['prob_density'], replace=False))
+    # closest observation first within each grid cell
+    order = np.lexsort((dist, codes))
+    _, first = np.unique(codes[order], return_index=True)
 
-    return adata[ixs].copy(), ixs
+    return np.sort(order[first])
 
 
-def get_xy_data(x, adata, adata_mraw, layer, indices, use_original_limits=False, inc=0):
+def _grid_cells(embedding, steps, coarse_steps=None):
+    # grid cell of each observation and the squared distance to the center of the cell,
+    # if `coarse_steps` is not `None`, the cells are merged into a coarser grid
+    steps = np.asarray(steps, dtype=np.int64)
+    minn, maxx = np.min(embedding, axis=0), np.max(embedding, axis=0)
+    delta = np.abs(maxx - minn)
+    # same grid as `np.linspace(minn - pad, maxx + pad, num=steps)`
+    minn, maxx = minn - 0.025 * delta, maxx + 0.025 * delta
+    step_size = (maxx - minn) / (steps - 1)
+    step_size[step_size == 0] = 1
 
-    def extract(data, ix):
-        if isinstance(data, anndata.core.anndata.Raw) or \
-            isinstance(data, anndata.AnnData):
-            return data.obs_vector(ix)[indices]
-        if issparse(data):
-            return np.squeeze(data.getcol(ix).A)[indices]
+    offset = (embedding - minn) / step_size
+    cell = np.clip(np.rint(offset), 0, steps - 1).astype(np.int64)
+    center = cell
 
-        # assume np.array
-        return data[indices, ix]
+    if coarse_steps is not None:
+        coarse_steps = np.asarray(coarse_steps, dtype=np.int64)
+        cell = cell * coarse_steps // steps
+        # first and last cell of the fine grid within each coarse cell
+        first, last = -(-cell * steps // coarse_steps), -(-(cell + 1) * steps // coarse_steps) - 1
+        center, steps = (first + last) / 2, coarse_steps
 
-    xlim = None
-    msg = f'Unable to decode key `{x}`.'
+    codes = np.ravel_multi_index(cell.T, steps)
+    dist = np.sum(((offset - center) * step_size) ** 2, axis=1)
 
-    if layer is None:
-        take_from = adata_mraw
-    else:
-        # mraw is always adata in this case
-        assert layer in adata.layers, f'Layer `\'{layer}\'` not found in `adata.layers`.'
-        assert adata is adata_mraw, 'Sanity check failed.'
-        take_from = adata.layers[layer]
+    return codes, dist
 
-    if not isinstance(x, int):
-        assert isinstance(x, str)
-        # can't use take from, since it can be an array
-        if x in adata_mraw.var_names:
-            ix = np.where(x == adata_mraw.var_names)[0][0]
-            xlabel = adata_mraw.var_names[ix]
-            x = extract(take_from, ix)
 
-            return x, xlabel, xlim
+def voxel_sample_ixs(adata, steps, bs='umap', components=(0, 1, 2)):
+    '''
+    Uniformly subsample the embedding, keeping one observation per occupied voxel.
 
-        if x in adata_mraw.obs_keys():
-            x, xlabel = adata_mraw.obs[x].values, x
-            if use_original_limits:
-                xlim = pad(*minmax(x))
+    Unlike `sample_unif`, the data is not copied and the indices
+    are cached for each basis, components and steps.
 
-            return x[indices], xlabel, xlim
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    steps: Union[Int, Tuple[Int, ...]]
+        number of voxels in each direction
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm` without the `'X_'` prefix
+    components: Tuple[Int, ...], optional (default: `(0, 1, 2)`)
+        components of the basis to use
 
-        x = x.lstrip('X_')
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the subsampled observations
+    '''
+
+    cache = get_object_cache(adata).setdefault('voxels', {})
+    key = (bs, tuple(components), tuple(steps) if isinstance(steps, (tuple, list)) else steps)
+    basis = adata.obsm[f'X_{bs}']
+    if key in cache and cache[key][0] is basis:  # invalidate if the basis has been replaced
+        return cache[key][1]
+
+    ixs = sample_unif_ixs(adata, steps, bs=bs, components=list(components))
+    ixs.setflags(write=False)
+    cache[key] = (basis, ixs)
+
+    return ixs
+
+
+def voxel_lod_ixs(adata, steps, bs='umap', components=(0, 1, 2)):
+    '''
+    Create a nested hierarchy of voxel subsamples, from coarse to fine.
+
+    The voxels of the coarser levels are unions of the voxels of the finest level.
+    Each level keeps the observations of the coarser levels and adds the closest
+    observation only for the voxels which don't contain any of them yet.
+    The finest level therefore has one observation per occupied voxel,
+    same as `voxel_sample_ixs`, although the representatives may differ.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    steps: List[Union[Int, Tuple[Int, ...], NoneType]]
+        number of voxels in each direction for each level, from coarse to fine,
+        `None` corresponds to all observations and can only be the last level
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm` without the `'X_'` prefix
+    components: Tuple[Int, ...], optional (default: `(0, 1, 2)`)
+        components of the basis to use
+
+    Returns
+    --------
+    (ixs, offsets): Tuple[np.ndarray, np.ndarray]
+        indices of the observations, ordered by level, and the end of each level,
+        i.e. level `i` consists of the observations `ixs[:offsets[i]]`
+    '''
+
+    assert len(steps), 'No levels have been specified.'
+
+    cache = get_object_cache(adata).setdefault('voxels', {})
+    key = ('lod', bs, tuple(components), tuple(tuple(s) if isinstance(s, (tuple, list)) else s for s in steps))
+    basis = adata.obsm[f'X_{bs}']
+    if key in cache and cache[key][0] is basis:  # invalidate if the basis has been replaced
+        return cache[key][1]
+
+    emb = np.asarray(basis[:, list(components)], dtype=np.float64)
+    n_obs, n_dim = emb.shape
+    assert all(s is not None for s in steps[:-1]), 'Only the last level can contain all observations.'
+
+    grids = [s if isinstance(s, (tuple, list, np.ndarray)) or s is None else [s] * n_dim for s in steps]
+    for s in filter(lambda s: s is not None, grids):
+        assert len(s) == n_dim, f'Expected `{n_dim}` steps, found `{len(s)}`.'
+        assert all(st > 1 for st in s), f'All steps must be `> 1`, found `{list(s)}`.'
+    # the finest grid, which the coarser grids are made of
+    fine = np.array([s for s in grids if s is not None] or [[2] * n_dim], dtype=np.int64)
+    assert np.all(np.diff(fine, axis=0) >= 0), f'Steps must be increasing, found `{list(steps)}`.'
+    fine = fine[-1]
+
+    seen = np.zeros(n_obs, dtype=bool)
+    levels, offsets = [], []
+
+    for s in grids:
+        if s is None:
+            ixs = np.flatnonzero(~seen)
+        else:
+            codes, dist = _grid_cells(emb, fine, coarse_steps=s)
+            # only the voxels not covered by the coarser levels
+            ixs = np.flatnonzero(~np.isin(codes, codes[seen]))
+            order = ixs[np.lexsort((dist[ixs], codes[ixs]))]
+            _, first = np.unique(codes[order], return_index=True)
+            ixs = np.sort(order[first])
+
+        seen[ixs] = True
+        levels.append(ixs)
+        offsets.append(len(ixs) + (offsets[-1] if offsets else 0))
+
+    res = np.concatenate(levels), np.array(offsets)
+    for arr in res:
+        arr.setflags(write=False)
+    cache[key] = (basis, res)
+
+    return res
+
+
+def sample_unif(adata, steps, bs='umap', components=(0, 1)):
+    ixs = sample_unif_ixs(adata, steps, bs=bs, components=components)
+
+    return adata[ixs, :].copy(), ixs
+
+
+def sample_density_ixs(adata, size, bs='umap', seed=None, components=[0, 1]):
+    '''
+    Subsample the embedding based on the density of the cells.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    size: Int
+        number of observations to keep
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm` without the `'X_'` prefix
+    seed: Int, optional (default: `None`)
+        random seed
+    components: List[Int], optional (default: `[0, 1]`)
+        components of the basis to use
+
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the subsampled observations
+    '''
+
+    if size >= adata.n_obs:
+        return np.arange(adata.n_obs)
+
+    state = np.random.RandomState(seed)
+    # Gumbel top-k trick: taking the `size` largest `log(p) + Gumbel(0, 1)` keys is the same
+    # as sampling without replacement with probabilities `p`, here `p ~ exp(density)`
+    keys = state.gumbel(size=adata.n_obs)
+    if components[0] != components[1]:
+        keys += embedding_density(adata, bs, components=components)
+
+    ixs = np.argpartition(-keys, size - 1)[:size]
+
+    return np.sort(ixs)
+
+
+def embedding_density(adata, bs='umap', components=[0, 1], bins=256):
+    '''
+    Estimate the density of cells in an embedding.
+
+    The density is computed using a binned Gaussian kernel density estimate
+    (with Scott's bandwidth) and is scaled to `[0, 1]`, similarly to `sc.tl.embedding_density`.
+    The result is cached for each `adata`, basis and components.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm` without the `'X_'` prefix
+    components: List[Int], optional (default: `[0, 1]`)
+        components of the basis to use
+    bins: Int, optional (default: `256`)
+        number of bins in each direction
+
+    Returns
+    --------
+    density: np.ndarray
+        density for each observation
+    '''
+
+    cache = get_object_cache(adata).setdefault('density', {})
+    key = (bs, tuple(components), bins)
+    basis = adata.obsm[f'X_{bs}']
+    if key in cache and cache[key][0] is basis:  # invalidate if the basis has been replaced
+        return cache[key][1]
+
+    from scipy.ndimage import gaussian_filter
+
+    emb = np.asarray(basis[:, list(components)], dtype=np.float64)
+    n_obs, n_dim = emb.shape
+
+    minn, maxx = np.min(emb, axis=0), np.max(emb, axis=0)
+    bin_size = (maxx - minn) / bins
+    bin_size[bin_size == 0] = 1
+
+    cell = np.clip(((emb - minn) / bin_size).astype(np.int64), 0, bins - 1)
+    counts = np.zeros((bins, ) * n_dim)
+    np.add.at(counts, tuple(cell.T), 1)
+
+    bw = np.std(emb, axis=0) * n_obs ** (-1. / (n_dim + 4))
+    density = gaussian_filter(counts, sigma=bw / bin_size, mode='constant')[tuple(cell.T)]
+
+    minn, maxx = np.min(density), np.max(density)
+    density = (density - minn) / (maxx - minn) if maxx > minn else np.zeros_like(density)
+    cache[key] = (basis, density)
+
+    return density
+
+
+def sample_density(adata, size, bs='umap', seed=None, components=[0, 1]):
+    ixs = sample_density_ixs(adata, size, bs=bs, seed=seed, components=components)
+
+    return adata[ixs, :].copy(), ixs
+
+
+def use_expression_cache(enabled=True, max_bytes=None, chunk_size=None):
+    '''
+    Enable or disable the column-oriented cache of sparse expression matrices.
+
+    When enabled, a CSC copy of `adata.X` (or of `adata.raw.X`, `adata.layers[...]`)
+    is created upon first access of a gene, making the subsequent accesses fast.
+    If the copy would exceed `max_bytes`, columns are converted in chunks
+    of `chunk_size` genes and the least recently used chunks are evicted.
+    The copy is recreated if the matrix is modified in place, views are never cached.
+
+    Params
+    --------
+    enabled: Bool, optional (default: `True`)
+        whether to use the cache
+    max_bytes: Int, optional (default: `None`)
+        memory budget per matrix, if `None`, keep the previous value (default `1GiB`)
+    chunk_size: Int, optional (default: `None`)
+        number of genes per chunk, if `None`, keep the previous value (default `1024`)
+
+    Returns
+    --------
+    None
+    '''
+
+    if max_bytes is not None:
+        assert max_bytes > 0, f'`max_bytes` must be positive, found `{max_bytes}`.'
+        EXPRESSION_CACHE['max_bytes'] = max_bytes
+    if chunk_size is not None:
+        assert chunk_size > 0, f'`chunk_size` must be positive, found `{chunk_size}`.'
+        EXPRESSION_CACHE['chunk_size'] = chunk_size
+
+    EXPRESSION_CACHE['enabled'] = enabled
+
+
+class ExpressionStore:
+    '''
+    Column-oriented view of a row-major sparse matrix.
+    '''
+
+    def __init__(self, X, max_bytes, chunk_size):
+        self.X = X
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        # requested settings, `chunk_size` is changed below if the whole matrix fits
+        self.settings = (max_bytes, chunk_size)
+        self.fingerprint = self.get_fingerprint(X)
+        self.nbytes = 0
+        self._chunks = odict()
+
+        size = X.data.nbytes + X.indices.nbytes + (X.shape[1] + 1) * X.indptr.itemsize
+        # single chunk if everything fits
+        if size <= max_bytes:
+            self.chunk_size = max(X.shape[1], 1)
+
+    @staticmethod
+    def get_fingerprint(X):
+        '''
+        Get a cheap fingerprint of a sparse matrix.
+
+        Besides the shape and the buffers, a strided sample of the values
+        is used to detect in-place modifications, such as normalization.
+
+        Params
+        --------
+        X: scipy.sparse.csr_matrix
+            sparse matrix
+
+        Returns
+        --------
+        fingerprint: Tuple
+            fingerprint of the matrix
+        '''
+
+        sample = X.data[::max(X.nnz // 1024, 1)]
+
+        return (X.shape, X.nnz, X.data.ctypes.data, X.indices.ctypes.data, X.indptr.ctypes.data,
+                hash(sample.tobytes()))
+
+    def is_valid(self, X):
+        '''
+        Check whether the store is up to date with a matrix and the cache settings.
+
+        Params
+        --------
+        X: scipy.sparse.csr_matrix
+            sparse matrix
+
+        Returns
+        --------
+        is_valid: Bool
+            `True` if the store can be used for `X`
+        '''
+
+        return self.settings == (EXPRESSION_CACHE['max_bytes'], EXPRESSION_CACHE['chunk_size']) and \
+            self.fingerprint == self.get_fingerprint(X)
+
+    def _get_chunk(self, i):
+        if i in self._chunks:
+            self._chunks.move_to_end(i)
+            return self._chunks[i]
+
+        start = i * self.chunk_size
+        chunk = self.X[:, start:start + self.chunk_size].tocsc()
+        self._chunks[i] = chunk
+        self.nbytes += chunk.data.nbytes + chunk.indices.nbytes + chunk.indptr.nbytes
+
+        while self.nbytes > self.max_bytes and len(self._chunks) > 1:
+            _, evicted = self._chunks.popitem(last=False)
+            self.nbytes -= evicted.data.nbytes + evicted.indices.nbytes + evicted.indptr.nbytes
+
+        return chunk
+
+    def column(self, ix):
+        '''
+        Get a dense column of the matrix.
+
+        Params
+        --------
+        ix: Int
+            index of the column
+
+        Returns
+        --------
+        column: np.ndarray
+            array of shape `(n_obs,)`
+        '''
+
+        chunk = self._get_chunk(ix // self.chunk_size)
+        ix %= self.chunk_size
+        start, end = chunk.indptr[ix], chunk.indptr[ix + 1]
+
+        res = np.zeros(chunk.shape[0], dtype=chunk.dtype)
+        res[chunk.indices[start:end]] = chunk.data[start:end]
+
+        return res
+
+
+def is_view(adata):
+    '''
+    Check whether the data of an object is created on every access.
+
+    Params
+    --------
+    adata: Union[anndata.AnnData, anndata.Raw]
+        anndata object or its `.raw` attribute
+
+    Returns
+    --------
+    is_view: Bool
+        `True` if `adata` or the object `adata.raw` belongs to is a view
+    '''
+
+    return bool(getattr(adata, 'is_view', False) or getattr(getattr(adata, '_adata', None), 'is_view', False))
+
+
+def get_column(X, ix, cache=True):
+    '''
+    Get a dense column of a (maybe sparse) matrix.
+
+    Params
+    --------
+    X: Union[np.ndarray, scipy.sparse.spmatrix]
+        matrix, such as `adata.X`
+    ix: Int
+        index of the column
+    cache: Bool, optional (default: `True`)
+        whether to use the expression cache, see `use_expression_cache`,
+        should be `False` for matrices that are created on every access, such as `view.X`
+
+    Returns
+    --------
+    column: np.ndarray
+        array of shape `(n_obs,)`
+    '''
+
+    if not issparse(X):
+        return np.ravel(X[:, ix])
+
+    if cache and EXPRESSION_CACHE['enabled'] and X.format == 'csr':
+        cache = get_object_cache(X)
+        store = cache.get('expression', None)
+        if store is None or not store.is_valid(X):
+            store = cache['expression'] = ExpressionStore(X, EXPRESSION_CACHE['max_bytes'],
+                                                          EXPRESSION_CACHE['chunk_size'])
+        return store.column(ix)
+
+    return np.ravel(X.getcol(ix).toarray())
+
+
+def get_expression(adata, gene, layer=None):
+    '''
+    Get the expression of a gene for all observations.
+
+    Params
+    --------
+    adata: Union[anndata.AnnData, anndata.Raw]
+        anndata object or its `.raw` attribute
+    gene: Union[Str, Int]
+        gene in `adata.var_names` or its index
+    layer: Str, optional (default: `None`)
+        key in `adata.layers`, if `None`, use `adata.X`
+
+    Returns
+    --------
+    expression: np.ndarray
+        array of shape `(n_obs,)`
+    '''
+
+    if isinstance(gene, (int, np.integer)):
+        ix = gene
+    else:
+        ix = get_resolver(adata).find('var_names', gene)
+        if ix is None:
+            raise KeyError(f'Gene `{gene}` not found in `adata.var_names`.')
+
+    return get_column(adata.X if layer is None else adata.layers[layer], ix, cache=not is_view(adata))
+
+
+def get_xy_data(x, adata, adata_mraw, layer, indices, use_original_limits=False, inc=0):
+
+    import anndata
+
+    def extract(data, ix):
+        if isinstance(data, anndata.core.anndata.Raw) or \
+            isinstance(data, anndata.AnnData):
+            return get_expression(data, ix)[indices]
+        if issparse(data):
+            return get_column(data, ix)[indices]
+
+        # assume np.array
+        return data[indices, ix]
+
+    xlim = None
+    msg = f'Unable to decode key `{x}`.'
+
+    if layer is None:
+        take_from = adata_mraw
+    else:
+        # mraw is always adata in this case
+        assert layer in adata.layers, f'Layer `\'{layer}\'` not found in `adata.layers`.'
+        assert adata is adata_mraw, 'Sanity check failed.'
+        take_from = adata.layers[layer]
+
+    if not isinstance(x, int):
+        assert isinstance(x, str)
+        # can't use take from, since it can be an array
+        ix = get_resolver(adata_mraw).find('var_names', x)
+        if ix is not None:
+            xlabel = adata_mraw.var_names[ix]
+            x = extract(take_from, ix)
+
+            return x, xlabel, xlim
+
+        if x in adata_mraw.obs_keys():
+            x, xlabel = adata_mraw.obs[x].values, x
+            if use_original_limits:
+                xlim = pad(*minmax(x))
+
+            return x[indices], xlabel, xlim
+
+        x = x.lstrip('X_')
         comp, *ix = x.split(':')
         ix = int(ix[0]) if len(ix) else (int(x == 'diffmap') + inc)
 
@@ -606,3 +1592,829 @@ def get_mraw(adata, use_raw):
 
     return adata.raw if hasattr(adata, 'raw') and adata.raw is not None else adata
 
+
+
+def get_edges(data, directed=True, filter_edges=None, top_n_edges=None):
+    '''
+    Extract the (filtered) edges of an adjacency matrix.
+
+    Params
+    --------
+    data: Union[np.ndarray, scipy.sparse.spmatrix]
+        square adjacency matrix
+    directed: Bool, optional (default: `True`)
+        whether the graph is directed or not
+        if `False`, each pair of nodes has at most 1 edge,
+        taken from the upper triangle, if present
+    filter_edges: Tuple[Float, Float], optional (default: `None`)
+        min and max threshold values for the weights
+    top_n_edges: Union[Int, Tuple[Int, Bool, Str]], optional (default: `None`)
+        maximum number of edges per node to keep
+        if a tuple, the second element specifies whether it's ascending or not
+        the third one whether whether to consider outgoing ('out') or ('in') incoming edges
+
+    Returns
+    --------
+    source, target, weight: np.ndarray
+        arrays of shape `(n_edges,)`
+    '''
+
+    from scipy.sparse import csr_matrix, triu, tril
+
+    data = data.tocsr() if issparse(data) else csr_matrix(data)
+    if not directed:
+        upper, lower = triu(data, format='csr'), tril(data, k=-1, format='csr').T.tocsr()
+        data = upper + lower - lower.multiply(upper != 0)
+
+    data = data.tocoo()
+    source, target, weight = data.row, data.col, data.data
+
+    if filter_edges is not None:
+        minn, maxx = filter_edges
+        minn = minn if minn is not None else -np.inf
+        maxx = maxx if maxx is not None else np.inf
+        mask = (weight >= minn) & (weight <= maxx)
+        source, target, weight = source[mask], target[mask], weight[mask]
+
+    if top_n_edges is not None:
+        if isinstance(top_n_edges, (tuple, list)):
+            to_keep, ascending, group_by = top_n_edges
+        else:
+            to_keep, ascending, group_by = top_n_edges, False, 'out'
+
+        group = source if group_by == 'out' else target
+        order = np.lexsort((weight if ascending else -weight, group))
+        # rank of each edge within its group
+        starts = np.flatnonzero(np.r_[True, np.diff(group[order]) != 0]) if len(order) else np.array([], dtype=np.int64)
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        mask = np.sort(order[rank < to_keep])
+        source, target, weight = source[mask], target[mask], weight[mask]
+
+    return source, target, weight
+
+
+def to_networkx(source, target, weight, n_nodes, directed=True):
+    '''
+    Create a `networkx` graph from the edges.
+
+    Params
+    --------
+    source, target, weight: np.ndarray
+        arrays of shape `(n_edges,)`
+    n_nodes: Int
+        number of nodes
+    directed: Bool, optional (default: `True`)
+        whether the graph is directed or not
+
+    Returns
+    --------
+    graph: Union[nx.Graph, nx.DiGraph]
+        graph with nodes `0, ..., n_nodes - 1`
+    '''
+
+    import networkx as nx
+
+    graph = nx.DiGraph() if directed else nx.Graph()
+    graph.add_nodes_from(range(n_nodes))
+    graph.add_weighted_edges_from(zip(source.tolist(), target.tolist(), weight.tolist()))
+
+    return graph
+
+
+def get_node_metrics(source, target, weight, n_nodes, directed=True, weighted=False, pagerank=False):
+    '''
+    Compute the degrees and degree centralities of the nodes.
+
+    Params
+    --------
+    source, target, weight: np.ndarray
+        arrays of shape `(n_edges,)`
+    n_nodes: Int
+        number of nodes
+    directed: Bool, optional (default: `True`)
+        whether the graph is directed or not
+    weighted: Bool, optional (default: `False`)
+        whether to use the edge weights when computing the degree
+        centralities are always computed from the unweighted degree
+    pagerank: Bool, optional (default: `False`)
+        whether to also compute the PageRank, see `pagerank`
+
+    Returns
+    --------
+    metrics: collections.OrderedDict
+        mapping of metric names to arrays of shape `(n_nodes,)`
+    '''
+
+    from scipy.sparse import csr_matrix, diags
+
+    adj = csr_matrix((weight, (source, target)), shape=(n_nodes, n_nodes))
+    out_count, in_count = np.diff(adj.indptr), np.bincount(adj.indices, minlength=n_nodes)
+    if weighted:
+        out_degree, in_degree = np.asarray(adj.sum(axis=1)).ravel(), np.asarray(adj.sum(axis=0)).ravel()
+    else:
+        out_degree, in_degree = out_count, in_count
+    scale = 1 / (n_nodes - 1) if n_nodes > 1 else 1
+
+    if directed:
+        metrics = odict([('indegree', in_degree), ('outdegree', out_degree),
+                         ('indegree centrality', in_count * scale), ('outdegree centrality', out_count * scale)])
+    else:
+        # self loops are counted twice
+        metrics = odict([('degree', in_degree + out_degree), ('centrality', (in_count + out_count) * scale)])
+
+    if pagerank:
+        if not directed:
+            adj = adj + adj.T - diags(adj.diagonal())
+        metrics['pagerank'] = sparse_pagerank(adj)
+
+    return metrics
+
+
+def sparse_pagerank(adj, alpha=0.85, max_iter=100, tol=1e-6):
+    '''
+    Compute the PageRank of the nodes using the power iteration.
+
+    Params
+    --------
+    adj: scipy.sparse.spmatrix
+        weighted adjacency matrix of a directed graph
+    alpha: Float, optional (default: `0.85`)
+        damping factor
+    max_iter: Int, optional (default: `100`)
+        maximum number of iterations
+    tol: Float, optional (default: `1e-6`)
+        tolerance (per node) used for checking the convergence
+
+    Returns
+    --------
+    pagerank: np.ndarray
+        PageRank of the nodes, sums to `1`
+    '''
+
+    adj = adj.tocsr()
+    n_nodes = adj.shape[0]
+    if n_nodes == 0:
+        return np.array([], dtype=np.float64)
+
+    out_weight = np.asarray(adj.sum(axis=1), dtype=np.float64).ravel()
+    dangling = out_weight == 0
+    inv_weight = np.divide(1, out_weight, out=np.zeros_like(out_weight), where=~dangling)
+    adj_t = adj.T.tocsr()
+
+    x = np.full(n_nodes, 1 / n_nodes)
+    for _ in range(max_iter):
+        x_prev = x
+        # dangling nodes are connected to every node
+        x = alpha * (adj_t @ (x_prev * inv_weight)) + (alpha * np.sum(x_prev[dangling]) + 1 - alpha) / n_nodes
+        if np.sum(np.abs(x - x_prev)) < n_nodes * tol:
+            break
+    else:
+        warnings.warn(f'PageRank did not converge in `{max_iter}` iterations.')
+
+    return x
+
+
+def use_layout_cache(cache_dir=None, max_size=None):
+    '''
+    Configure the cache of the graph layouts.
+
+    The layouts are always cached in memory. If `cache_dir` is specified,
+    they are also saved to and loaded from the disk, persisting across sessions.
+
+    Params
+    --------
+    cache_dir: Str, optional (default: `None`)
+        directory where to store the layouts, if `None`, only use the memory
+    max_size: Int, optional (default: `None`)
+        maximum number of layouts kept in memory, if `None`, keep the previous value (default `64`)
+
+    Returns
+    --------
+    None
+    '''
+
+    import os
+
+    if max_size is not None:
+        assert max_size > 0, f'`max_size` must be positive, found `{max_size}`.'
+        LAYOUT_CACHE['max_size'] = max_size
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    LAYOUT_CACHE['cache_dir'] = cache_dir
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(f'{obj.dtype}{obj.shape}'.encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for k in sorted(obj.keys(), key=repr):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (tuple, list)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for o in obj:
+            _update_hash(h, o)
+    else:
+        h.update(repr(obj).encode())
+
+
+def graph_fingerprint(source, target, weight, n_nodes, directed=True):
+    '''
+    Compute the fingerprint of a graph.
+
+    Params
+    --------
+    source, target, weight: np.ndarray
+        arrays of shape `(n_edges,)`
+    n_nodes: Int
+        number of nodes
+    directed: Bool, optional (default: `True`)
+        whether the graph is directed or not
+
+    Returns
+    --------
+    fingerprint: Str
+        hex digest identifying the graph
+    '''
+
+    from hashlib import sha1
+
+    h = sha1()
+    _update_hash(h, (n_nodes, directed, source, target, weight))
+
+    return h.hexdigest()
+
+
+def get_layout(layout, source, target, weight, n_nodes, directed=True, layout_kwargs={}, fingerprint=None):
+    '''
+    Get the (cached) positions of the nodes for a given layout.
+
+    Params
+    --------
+    layout: Str
+        name of the layout, see `get_default_layouts`
+    source, target, weight: np.ndarray
+        arrays of shape `(n_edges,)`
+    n_nodes: Int
+        number of nodes
+    directed: Bool, optional (default: `True`)
+        whether the graph is directed or not
+    layout_kwargs: Dict, optional (default: `{}`)
+        kwargs for the layout
+    fingerprint: Str, optional (default: `None`)
+        fingerprint of the graph, if `None`, compute it using `graph_fingerprint`
+
+    Returns
+    --------
+    positions: np.ndarray
+        array of shape `(n_nodes, 2)`
+    '''
+
+    import os
+    from hashlib import sha1
+
+    layouts = get_default_layouts()
+    assert layout in layouts, f'Unknown layout `{layout}`. Available layouts are `{list(layouts.keys())}`.'
+
+    if fingerprint is None:
+        fingerprint = graph_fingerprint(source, target, weight, n_nodes, directed=directed)
+    h = sha1(fingerprint.encode())
+    _update_hash(h, (layout, layout_kwargs))
+    key = h.hexdigest()
+
+    if key in _LAYOUT_CACHE:
+        _LAYOUT_CACHE.move_to_end(key)
+        return _LAYOUT_CACHE[key]
+
+    cache_dir = LAYOUT_CACHE['cache_dir']
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{layout}_{key}.npy')
+
+    if path is not None and os.path.isfile(path):
+        positions = np.load(path)
+    elif layout == 'multilevel':
+        from scipy.sparse import csr_matrix
+
+        adj = csr_matrix((weight, (source, target)), shape=(n_nodes, n_nodes))
+        positions = multilevel_layout(adj, **layout_kwargs)
+    else:
+        graph = to_networkx(source, target, weight, n_nodes, directed=directed)
+        positions = layouts[layout](graph, **layout_kwargs)
+        positions = np.array([positions[i] for i in range(n_nodes)], dtype=np.float64).reshape(n_nodes, 2)
+
+    if path is not None and not os.path.isfile(path):
+        np.save(path, positions)
+
+    positions.flags.writeable = False
+    _LAYOUT_CACHE[key] = positions
+    while len(_LAYOUT_CACHE) > LAYOUT_CACHE['max_size']:
+        _LAYOUT_CACHE.popitem(last=False)
+
+    return positions
+
+
+def multilevel_layout(adj, init=None, n_iter=50, max_time=None, theta=1.0, min_size=64, seed=None):
+    '''
+    Force-directed layout for large graphs.
+
+    The graph is repeatedly coarsened by merging the pairs of mutually heaviest neighbors.
+    The coarsest graph is laid out first and the positions are refined level by level
+    using Fruchterman-Reingold forces, where the repulsive forces are approximated
+    using the Barnes-Hut quadtree.
+
+    Params
+    --------
+    adj: Union[np.ndarray, scipy.sparse.spmatrix]
+        weighted adjacency matrix, the edge directions are ignored
+    init: np.ndarray, optional (default: `None`)
+        array of shape `(n_nodes, 2)` of initial positions, e.g. from `adata.obsm`
+        if given, the coarsening is skipped and only the positions are refined
+    n_iter: Int, optional (default: `50`)
+        number of iterations per level
+    max_time: Float, optional (default: `None`)
+        time budget in seconds, after which the remaining levels are only interpolated
+    theta: Float, optional (default: `1.0`)
+        Barnes-Hut opening angle, smaller values are more accurate
+    min_size: Int, optional (default: `64`)
+        stop coarsening once the graph has less nodes
+    seed: Int, optional (default: `None`)
+        random seed
+
+    Returns
+    --------
+    positions: np.ndarray
+        array of shape `(n_nodes, 2)` scaled to `[-1, 1]`
+    '''
+
+    from scipy.sparse import csr_matrix, diags
+    from time import perf_counter
+
+    adj = csr_matrix(adj, dtype=np.float64)
+    assert adj.shape[0] == adj.shape[1], f'Adjacency matrix is not square, found shape `{adj.shape}`.'
+    assert n_iter >= 0, f'`n_iter` must be non-negative, found `{n_iter}`.'
+
+    n_nodes = adj.shape[0]
+    if n_nodes == 0:
+        return np.zeros((0, 2))
+
+    adj = abs(adj)
+    adj = adj + adj.T
+    adj = (adj - diags(adj.diagonal())).tocsr()
+    adj.eliminate_zeros()
+
+    state = np.random.RandomState(seed)
+    deadline = np.inf if max_time is None else perf_counter() + max_time
+
+    if init is not None:
+        pos = np.array(init, dtype=np.float64)
+        assert pos.shape == (n_nodes, 2), f'Expected `init` of shape `{(n_nodes, 2)}`, found `{pos.shape}`.'
+        # make the median edge length `1`
+        source, target = adj.nonzero()
+        dist = np.linalg.norm(pos[source] - pos[target], axis=1) if len(source) else np.ones(1)
+        scale = np.median(dist)
+        pos = pos / (scale if scale > 0 else 1)
+
+        pos = _force_layout(adj, pos, np.ones(n_nodes), n_iter, 0.5, theta, deadline)
+        return _rescale(pos)
+
+    levels, mappings = [(adj, np.ones(n_nodes))], []
+    while levels[-1][0].shape[0] > min_size:
+        adj, mass = levels[-1]
+        labels = _coarsen(adj, state)
+        n_clusters = np.max(labels) + 1
+        if n_clusters > 0.9 * adj.shape[0]:  # no progress
+            break
+
+        # indicator matrix
+        ind = csr_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)), shape=(len(labels), n_clusters))
+        adj = ind.T @ adj @ ind
+        adj = (adj - diags(adj.diagonal())).tocsr()
+        adj.eliminate_zeros()
+
+        levels.append((adj, np.bincount(labels, weights=mass, minlength=n_clusters)))
+        mappings.append(labels)
+
+    adj, mass = levels[-1]
+    pos = state.uniform(-1, 1, size=(adj.shape[0], 2)) * np.sqrt(np.sum(mass))
+    pos = _force_layout(adj, pos, mass, n_iter, 0.1 * np.sqrt(np.sum(mass)) + 1, theta, deadline)
+
+    for (adj, mass), labels in zip(levels[-2::-1], mappings[::-1]):
+        pos = pos[labels] + state.normal(scale=0.5, size=(len(labels), 2))
+        pos = _force_layout(adj, pos, mass, n_iter, 1, theta, deadline)
+
+    return _rescale(pos)
+
+
+def _rescale(pos):
+    pos = pos - np.mean(pos, axis=0)
+    maxx = np.max(np.abs(pos)) if len(pos) else 0
+
+    return pos / maxx if maxx > 0 else pos
+
+
+def _coarsen(adj, state, n_rounds=4):
+    # heavy edge matching, in each round, the mutually heaviest neighbors are matched
+    n_nodes = adj.shape[0]
+    adj = adj.tocoo()
+    source, target = adj.row, adj.col
+    # random tie breaking
+    weight = adj.data * (1 + 1e-6 * state.uniform(size=len(adj.data)))
+    partner = np.arange(n_nodes)
+
+    for _ in range(n_rounds):
+        mask = (partner[source] == source) & (partner[target] == target)
+        if not np.any(mask):
+            break
+        src, tgt, w = source[mask], target[mask], weight[mask]
+
+        order = np.lexsort((-w, src))
+        first = order[np.r_[True, src[order][1:] != src[order][:-1]]]
+        best = np.full(n_nodes, -1)
+        best[src[first]] = tgt[first]
+
+        ixs = np.flatnonzero(best >= 0)
+        ixs = ixs[best[best[ixs]] == ixs]
+        partner[ixs] = best[ixs]
+
+    _, labels = np.unique(np.minimum(np.arange(n_nodes), partner), return_inverse=True)
+
+    return labels
+
+
+def _force_layout(adj, pos, mass, n_iter, temperature, theta, deadline):
+    from time import perf_counter
+
+    adj = adj.tocoo()
+    source, target, weight = adj.row, adj.col, adj.data
+    n_nodes = len(pos)
+
+    for i in range(n_iter):
+        if perf_counter() > deadline:
+            break
+
+        # repulsion, the ideal edge length is `1`
+        disp = mass[:, None] * _barnes_hut(pos, mass, theta)
+
+        # attraction
+        delta = pos[source] - pos[target]
+        dist = np.linalg.norm(delta, axis=1)
+        attr = delta * (weight * dist)[:, None]
+        for d in range(2):
+            disp[:, d] -= np.bincount(source, weights=attr[:, d], minlength=n_nodes)
+
+        length = np.linalg.norm(disp, axis=1)
+        length[length == 0] = 1
+        step = temperature * (1 - i / n_iter)
+        pos = pos + disp * (np.minimum(length, step) / length)[:, None]
+
+    return pos
+
+
+def _interleave(x):
+    # spread the lower 16 bits, used for the Morton codes
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+def _barnes_hut(pos, mass, theta, max_depth=10, chunk_size=8192):
+    n_nodes = len(pos)
+    minn = np.min(pos, axis=0)
+    width = np.max(np.max(pos, axis=0) - minn)
+    width = width * (1 + 1e-9) if width > 0 else 1
+
+    # quadtree as a hierarchy of regular grids, indexed by the Morton codes
+    depth = int(np.clip(np.ceil(np.log(max(n_nodes, 2) / 4) / np.log(4)), 1, max_depth))
+    cells = np.minimum(((pos - minn) / width * 2 ** depth).astype(np.int64), 2 ** depth - 1)
+    morton = (_interleave(cells[:, 0]) << 1) | _interleave(cells[:, 1])
+    x, y = pos[:, 0], pos[:, 1]
+    # nodes sorted by their leaf, for the exact sums over the nearby leaves
+    order = np.argsort(morton, kind='stable')
+    leaf_codes = morton[order]
+
+    tree = [None]
+    for level in range(1, depth + 1):
+        code = morton >> (2 * (depth - level))
+        cell_mass = np.bincount(code, weights=mass, minlength=4 ** level)
+        denom = np.where(cell_mass > 0, cell_mass, 1)
+        tree.append((cell_mass, np.bincount(code, weights=mass * x, minlength=4 ** level) / denom,
+                     np.bincount(code, weights=mass * y, minlength=4 ** level) / denom,
+                     (width / 2 ** level) ** 2))
+
+    fx, fy = np.zeros(n_nodes), np.zeros(n_nodes)
+    theta2 = theta ** 2
+    for start in range(0, n_nodes, chunk_size):
+        node = np.repeat(np.arange(start, min(start + chunk_size, n_nodes)), 4)
+        code = np.tile(np.arange(4), len(node) // 4)
+
+        for level in range(1, depth + 1):
+            cell_mass, comx, comy, width2 = tree[level]
+            cm = cell_mass[code]
+            nonempty = cm > 0
+            node, code, cm = node[nonempty], code[nonempty], cm[nonempty]
+
+            own = (morton[node] >> (2 * (depth - level))) == code
+            dx, dy = x[node] - comx[code], y[node] - comy[code]
+            dist2 = np.maximum(dx * dx + dy * dy, 1e-6)
+            accept = (width2 < theta2 * dist2) & ~own
+
+            f = cm[accept] / dist2[accept]
+            acc_node = node[accept]
+            fx += np.bincount(acc_node, weights=dx[accept] * f, minlength=n_nodes)
+            fy += np.bincount(acc_node, weights=dy[accept] * f, minlength=n_nodes)
+
+            expand = ~accept
+            if level == depth:
+                # the own and the nearby leaves are summed exactly, point by point
+                node, code = node[expand], code[expand]
+                lo = np.searchsorted(leaf_codes, code, side='left')
+                counts = np.searchsorted(leaf_codes, code, side='right') - lo
+                other = order[np.arange(np.sum(counts)) + np.repeat(lo - np.cumsum(counts) + counts, counts)]
+                node = np.repeat(node, counts)
+                node, other = node[node != other], other[node != other]
+
+                dx, dy = x[node] - x[other], y[node] - y[other]
+                f = mass[other] / np.maximum(dx * dx + dy * dy, 1e-6)
+                fx += np.bincount(node, weights=dx * f, minlength=n_nodes)
+                fy += np.bincount(node, weights=dy * f, minlength=n_nodes)
+                break
+            node = np.repeat(node[expand], 4)
+            code = ((code[expand] << 2)[:, None] + np.arange(4)).ravel()
+
+    return np.stack([fx, fy], axis=1)
+
+
+def aggregate_graph(data, labels, n_clusters=None):
+    '''
+    Aggregate the nodes of a graph into clusters.
+
+    Params
+    --------
+    data: Union[np.ndarray, scipy.sparse.spmatrix]
+        square adjacency matrix
+    labels: np.ndarray
+        cluster of each node, in `0, ..., n_clusters - 1`
+    n_clusters: Int, optional (default: `None`)
+        number of clusters, if `None`, use `max(labels) + 1`
+
+    Returns
+    --------
+    adj: scipy.sparse.csr_matrix
+        adjacency matrix of shape `(n_clusters, n_clusters)`, containing
+        the sum of weights of the edges between the clusters, without self-loops
+    sizes: np.ndarray
+        number of nodes in each cluster
+    internal: np.ndarray
+        sum of weights of the edges within each cluster
+    '''
+
+    from scipy.sparse import csr_matrix
+
+    labels = np.asarray(labels)
+    assert len(labels) == data.shape[0], f'Expected `{data.shape[0]}` labels, found `{len(labels)}`.'
+    if n_clusters is None:
+        n_clusters = np.max(labels) + 1 if len(labels) else 0
+    if len(labels):
+        assert np.min(labels) >= 0 and np.max(labels) < n_clusters, \
+            f'Labels must be in `0, ..., {n_clusters - 1}`, found `{np.min(labels)}, ..., {np.max(labels)}`.'
+
+    ind = csr_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)), shape=(len(labels), n_clusters))
+    adj = (ind.T @ (data if issparse(data) else csr_matrix(data)) @ ind).tocsr()
+
+    # the weights within the clusters would dominate the weights between them
+    internal = adj.diagonal()
+    adj.setdiag(0)
+    adj.eliminate_zeros()
+
+    return adj, np.bincount(labels, minlength=n_clusters), internal
+
+
+def edge_segments(source, target, positions):
+    '''
+    Create the line segments of the edges, separated by `NaN`, e.g. for `datashader`.
+
+    Params
+    --------
+    source, target: np.ndarray
+        arrays of shape `(n_edges,)`
+    positions: np.ndarray
+        positions of the nodes of shape `(n_nodes, 2)`
+
+    Returns
+    --------
+    segments: np.ndarray
+        array of shape `(3 * n_edges, 2)`
+    '''
+
+    positions = np.asarray(positions, dtype=np.float64)
+    segments = np.full((len(source), 3, 2), np.nan)
+    segments[:, 0], segments[:, 1] = positions[source], positions[target]
+
+    return segments.reshape(-1, 2)
+
+
+def _bundle_key(positions, fingerprint, bundle_kwargs):
+    from hashlib import sha1
+
+    h = sha1(fingerprint.encode())
+    _update_hash(h, (np.asarray(positions, dtype=np.float64), bundle_kwargs))
+
+    return h.hexdigest()
+
+
+def _hammer_bundle(source, target, positions, bundle_kwargs):
+    from datashader.bundling import hammer_bundle
+
+    nodes = pd.DataFrame(np.asarray(positions, dtype=np.float64), columns=['x', 'y'])
+    edges = pd.DataFrame({'source': source, 'target': target})
+
+    return hammer_bundle(nodes, edges, **bundle_kwargs)
+
+
+def _cache_bundle(key, paths):
+    _BUNDLE_CACHE[key] = paths
+    while len(_BUNDLE_CACHE) > BUNDLE_CACHE_SIZE:
+        _BUNDLE_CACHE.popitem(last=False)
+
+
+def bundle_edges(source, target, positions, fingerprint=None, **kwargs):
+    '''
+    Bundle the edges using `datashader.bundling.hammer_bundle`.
+
+    The result is cached for the graph, its positions and the bundling parameters.
+
+    Params
+    --------
+    source, target: np.ndarray
+        arrays of shape `(n_edges,)`
+    positions: np.ndarray
+        positions of the nodes of shape `(n_nodes, 2)`
+    fingerprint: Str, optional (default: `None`)
+        fingerprint of the graph, if `None`, it's computed from the edges
+    **kwargs:
+        kwargs for `hammer_bundle`, e.g. `iterations`, `decay`, `weight`
+
+    Returns
+    --------
+    paths: pd.DataFrame
+        bundled edges with the columns `'x'` and `'y'`, separated by `NaN`
+    '''
+
+    if fingerprint is None:
+        fingerprint = graph_fingerprint(source, target, np.ones(len(source)), len(positions))
+    key = _bundle_key(positions, fingerprint, kwargs)
+
+    if key in _BUNDLE_CACHE:
+        _BUNDLE_CACHE.move_to_end(key)
+        return _BUNDLE_CACHE[key]
+
+    paths = _hammer_bundle(source, target, positions, kwargs)
+    _cache_bundle(key, paths)
+
+    return paths
+
+
+def precompute_bundles(source, target, positions, fingerprint=None, n_jobs=None, **kwargs):
+    '''
+    Bundle the edges for multiple node positions in parallel, see `bundle_edges`.
+
+    Params
+    --------
+    source, target: np.ndarray
+        arrays of shape `(n_edges,)`
+    positions: List[np.ndarray]
+        list of positions of the nodes, e.g. for each layout
+    fingerprint: Str, optional (default: `None`)
+        fingerprint of the graph, if `None`, it's computed from the edges
+    n_jobs: Int, optional (default: `None`)
+        number of worker processes, if `None`, use the number of processors
+    **kwargs:
+        kwargs for `hammer_bundle`
+
+    Returns
+    --------
+    paths: List[pd.DataFrame]
+        bundled edges for each positions
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if fingerprint is None:
+        fingerprint = graph_fingerprint(source, target, np.ones(len(source)), len(positions[0]) if len(positions) else 0)
+    keys = [_bundle_key(pos, fingerprint, kwargs) for pos in positions]
+    res = {k: _BUNDLE_CACHE[k] for k in keys if k in _BUNDLE_CACHE}
+    todo = {k: pos for k, pos in zip(keys, positions) if k not in res}
+
+    if len(todo) == 1 or n_jobs == 1:
+        res.update({k: _hammer_bundle(source, target, pos, kwargs) for k, pos in todo.items()})
+    elif len(todo):
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {k: executor.submit(_hammer_bundle, source, target, pos, kwargs) for k, pos in todo.items()}
+            res.update({k: f.result() for k, f in futures.items()})
+
+    for k in keys:
+        _cache_bundle(k, res[k])
+
+    return [res[k] for k in keys]
+
+
+def split_paths(paths):
+    '''
+    Split the `NaN` separated paths.
+
+    Params
+    --------
+    paths: Union[pd.DataFrame, np.ndarray]
+        paths of shape `(n_points, 2)`, separated by `NaN`
+
+    Returns
+    --------
+    paths: List[np.ndarray]
+        list of paths without the `NaN`
+    '''
+
+    paths = np.asarray(paths, dtype=np.float64)[:, :2]
+    isnan = np.isnan(paths[:, 0])
+    starts = np.flatnonzero(~isnan & np.r_[True, isnan[:-1]])
+    ends = np.flatnonzero(~isnan & np.r_[isnan[1:], True]) + 1
+
+    return [paths[s:e] for s, e in zip(starts, ends)]
+
+
+def obs_columns(obs, keys):
+    '''
+    Get the columns of the observations as arrays, strings are converted to categoricals.
+
+    Params
+    --------
+    obs: pd.DataFrame
+        observations, such as `adata.obs`
+    keys: List[Str]
+        keys in `obs`
+
+    Returns
+    --------
+    columns: collections.OrderedDict
+        mapping of keys to `np.ndarray` or `pd.Categorical`
+    '''
+
+    from pandas.api.types import is_string_dtype
+
+    columns = odict()
+    for key in keys:
+        values = obs[key].values
+        if not isinstance(values, pd.Categorical) and is_string_dtype(values):
+            values = pd.Categorical(values)
+        columns[key] = values
+
+    return columns
+
+
+def induced_subgraph(data, ixs):
+    '''
+    Extract the subgraph induced by the nodes.
+
+    Params
+    --------
+    data: Union[np.ndarray, scipy.sparse.spmatrix]
+        square adjacency matrix
+    ixs: np.ndarray
+        indices of the nodes, the nodes in the subgraph are in this order
+
+    Returns
+    --------
+    data: Union[np.ndarray, scipy.sparse.csr_matrix]
+        adjacency matrix of shape `(len(ixs), len(ixs))`
+    '''
+
+    from scipy.sparse import csr_matrix
+
+    ixs = np.asarray(ixs, dtype=np.int64)
+    n_nodes = data.shape[0]
+    if len(ixs) == n_nodes and np.all(ixs == np.arange(n_nodes)):
+        return data
+
+    if not issparse(data):
+        return np.asarray(data)[np.ix_(ixs, ixs)]
+
+    data = data.tocsr()
+    if len(np.unique(ixs)) != len(ixs):  # duplicated nodes
+        return data[ixs, :][:, ixs]
+
+    # position of each node in the subgraph, `-1` if not present
+    remap = np.full(n_nodes, -1, dtype=np.int64)
+    remap[ixs] = np.arange(len(ixs))
+
+    # all the entries of the selected rows in one pass
+    starts, lengths = data.indptr[ixs], data.indptr[ixs + 1] - data.indptr[ixs]
+    offsets = np.cumsum(lengths) - lengths
+    entries = np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
+
+    cols = remap[data.indices[entries]]
+    mask = cols >= 0
+    rows = np.repeat(np.arange(len(ixs)), lengths)[mask]
+    indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=len(ixs)))]
+
+    return csr_matrix((data.data[entries][mask], cols[mask], indptr), shape=(len(ixs), len(ixs)))